@@ -0,0 +1,62 @@
+(ns benchmark
+  (:require [babashka.fs :as fs]
+            [cheshire.core :as json]
+            [file-processing :as fp]
+            [run-podman :as rp]))
+
+;; allowed slowdown compared to a baseline report, as a fraction
+(def ^:dynamic *tolerance* 0.2)
+
+(defn time-transcribe-all
+  "Times file-processing/transcribe-all on a copy of the audio files in dir with model,
+   so existing transcriptions in dir are neither used nor overwritten.
+   Returns a map with the number of files, the seconds it took and the settings of the run."
+  [dir model]
+  (let [copy-dir (fs/create-temp-dir {:prefix "whisper-benchmark"})]
+    (try
+      (doseq [file (fs/list-dir dir)
+              :when (and (fs/regular-file? file) (fp/transcribe? file model))]
+        (fs/copy file copy-dir {:copy-attributes true}))
+      (let [start (System/nanoTime)
+            results (fp/transcribe-all (str copy-dir) model Integer/MAX_VALUE)
+            seconds (/ (- (System/nanoTime) start) 1e9)]
+        {:model model
+         :files (count results)
+         :failed (count (filter #(= :failure (:status %)) results))
+         :seconds seconds
+         :files-per-minute (if (pos? seconds) (* 60 (/ (count results) seconds)) 0)
+         :workers fp/*workers*
+         :batch-size fp/*batch-size*})
+      (finally (fs/delete-tree copy-dir)))))
+
+(defn regressions
+  "Returns the transcribe-all timings of report more than *tolerance* slower than the same model in baseline."
+  [report baseline]
+  (let [previous (into {} (map (juxt :model identity)) (:transcribe-all baseline))]
+    (for [{:keys [model seconds]} (:transcribe-all report)
+          :let [before (get-in previous [model :seconds])]
+          :when (and before (> seconds (* before (+ 1 *tolerance*))))]
+      {:model model :stage "transcribe_all_seconds" :baseline before :seconds seconds})))
+
+(defn run
+  "Runs the benchmark suite and writes its report as json to out.
+   The stages of every model are timed in a container on synthetic fixtures (or on the files in fixtures),
+   and transcribe-all is timed on dir for every model when dir is given.
+   With a baseline report of an earlier run, slower stages are listed under :regressions.
+   Takes a map so it can be called with bb -x benchmark/run --out report.json --dir ~/recordings.
+   Returns the report."
+  [{:keys [out dir models fixtures baseline]
+    :or {out "benchmark.json" models ["base"]}}]
+  (let [models (if (string? models) [models] models)
+        fixtures (if (string? fixtures) [fixtures] fixtures)
+        baseline-report (when baseline (json/parse-string (slurp (str baseline)) true))
+        stages (apply rp/benchmark-stages (map str fixtures) (some-> baseline str)
+                      "--tolerance" (str *tolerance*) "--model" models)
+        report {:stages stages
+                :transcribe-all (when dir (mapv #(time-transcribe-all dir %) models))}
+        report (assoc report :regressions (concat (:regressions stages)
+                                                  (when baseline-report (regressions report baseline-report))))]
+    (spit (str out) (json/generate-string report {:pretty true}))
+    (doseq [{:keys [model fixture stage baseline seconds]} (:regressions report)]
+      (println "Regression:" model fixture stage baseline "->" seconds))
+    report))
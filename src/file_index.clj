@@ -0,0 +1,95 @@
+(ns file-index
+  (:require [babashka.fs :as fs]
+            [babashka.pods :as pods]
+            [clojure.edn :as edn]))
+
+;; name of the index file kept in every indexed directory
+(def index-name ".alchemy-index.edn")
+
+(defn index-file
+  "Returns the path of the index file of dir, or of the index called name."
+  ([dir] (index-file dir index-name))
+  ([dir name] (fs/path dir name)))
+
+(defn- index-file?
+  "Checks if file is one of the index files written by whispering alchemy, they are never indexed themselves."
+  [file]
+  (.startsWith (str (fs/file-name file)) ".alchemy-"))
+
+(defn file-key
+  "Returns the index key of a file, its absolute path."
+  [file]
+  (str (fs/absolutize file)))
+
+(defn load-index
+  "Reads the index of dir, a map of file key to the size, mtime and processing state of the file,
+   or the index called name. Returns an empty index when dir has no such index or it can't be read."
+  ([dir] (load-index dir index-name))
+  ([dir name]
+   (let [file (index-file dir name)]
+     (if (fs/exists? file)
+       (try (edn/read-string (slurp (str file)))
+            (catch Exception _ {}))
+       {}))))
+
+(defn save-index
+  "Writes the index of dir, or the index called name. The file is replaced at once so an interrupted run
+   never leaves half an index."
+  ([dir index] (save-index dir index index-name))
+  ([dir index name]
+   (let [tmp (fs/create-temp-file {:dir dir :prefix name :suffix ".tmp"})]
+     (spit (str tmp) (pr-str index))
+     (fs/move tmp (index-file dir name) {:replace-existing true :atomic-move true}))))
+
+(defn file-stat
+  "Returns the size and mtime in milliseconds of file, read with a single stat."
+  [file]
+  (let [{:keys [size lastModifiedTime]} (fs/read-attributes file "size,lastModifiedTime")]
+    {:size size :mtime (fs/file-time->millis lastModifiedTime)}))
+
+(defn refresh
+  "Returns index updated to the regular files in dir.
+   Files with the same size and mtime keep their processing state, new or changed files start with an empty
+   state and files that are gone are dropped."
+  [index dir]
+  (into {}
+        (for [file (fs/list-dir dir)
+              :when (and (fs/regular-file? file) (not (index-file? file)))
+              :let [k (file-key file)
+                    stat (file-stat file)
+                    entry (get index k)]]
+          [k (if (= stat (select-keys entry [:size :mtime])) entry stat)])))
+
+(defn watch
+  "Calls (on-change) at the start and again every time files in dir were created, written or moved in
+   and then left alone for quiet-ms milliseconds, so files still being recorded aren't picked up half way.
+   When on-change returns a number it is called again once that time in epoch milliseconds has passed,
+   even without new files, so failed files are retried when their backoff ends.
+   Calls never overlap. Blocks until the thread is interrupted. Uses the babashka fswatcher pod."
+  [dir quiet-ms on-change]
+  (pods/load-pod 'org.babashka/fswatcher "0.0.5")
+  (let [watch-dir (requiring-resolve 'pod.babashka.fswatcher/watch)
+        last-event (atom nil)
+        wake-at (atom nil)
+        change! #(let [wake (on-change)]
+                   (reset! wake-at (when (number? wake) wake)))]
+    (watch-dir (str dir)
+               (fn [{:keys [type path]}]
+                 (when (and (#{:create :write :rename} type)
+                            (not (index-file? path)))
+                   (reset! last-event (System/currentTimeMillis))))
+               {:delay-ms 100})
+    (change!)
+    (loop []
+      (Thread/sleep 500)
+      (let [now (System/currentTimeMillis)
+            event-time @last-event]
+        (cond
+          (and event-time
+               (> (- now event-time) quiet-ms)
+               (compare-and-set! last-event event-time nil))
+          (change!)
+
+          (some->> @wake-at (>= now))
+          (change!)))
+      (recur))))
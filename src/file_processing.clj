@@ -2,13 +2,58 @@
   (:require [babashka.process :as p]
             [babashka.fs :as fs]
             [clojure.string :as str]
+            [clojure.edn :as edn]
+            [cheshire.core :as json]
             [babashka.pods :as pods]
-            [run-podman :as rp]))
+            [file-index :as fi]
+            [run-podman :as rp]
+            [sorting]
+            [transcript-index :as ti]))
 
 (def SUCCESS 0)
+;; models alchemize.py accepts, see model_choices in alchemize.py
+(def model-choices #{"tiny" "tiny.en" "base" "base.en" "small" "small.en" "medium.en" "turbo"})
 (def ^:dynamic *verbose* false)
 (def ^:dynamic *min-file-size* 100)
 (def ^:dynamic *max-file-size* 15000000)
+;; number of containers transcribing in parallel
+(def ^:dynamic *workers* 1)
+;; torch threads per container, nil splits the cores evenly between the workers
+(def ^:dynamic *torch-threads* nil)
+;; language of the recordings, "auto" uses the language detected while renaming, nil uses the container default
+(def ^:dynamic *lang* nil)
+;; only transcribe the speech found by voice activity detection
+(def ^:dynamic *vad* false)
+;; processes transcribing the chunks of a long recording, when set *max-file-size* no longer applies
+(def ^:dynamic *chunk-workers* nil)
+;; stream transcriptions of single files, writing a partial transcription file while transcribing
+(def ^:dynamic *stream* false)
+;; precision of cpu inference: "fp32", "int8" or "bf16", nil uses the container default
+(def ^:dynamic *precision* nil)
+;; larger model the low confidence segments of a transcription are transcribed again with, nil disables the cascade
+(def ^:dynamic *cascade-model* nil)
+;; words a recording is renamed with, nil uses the container default
+(def ^:dynamic *max-words* nil)
+;; seconds at the start of a recording decoded for its new name, nil uses the first 30 seconds
+(def ^:dynamic *words-window* nil)
+;; jobs sent to a container at once, words jobs among them are decoded as one batch
+(def ^:dynamic *batch-size* 8)
+;; collect the stage metrics of every request, run-pool prints a summary of them when the run is done
+(def ^:dynamic *metrics* false)
+;; keep an index of every processed directory (.alchemy-index.edn), so runs only look at new or changed files
+(def ^:dynamic *index* true)
+;; files written to more recently than this many milliseconds are left for a later run, they may still be recording
+(def ^:dynamic *settle-ms* 2000)
+;; order files are processed in: :newest or :oldest first by mtime, :smallest or :largest first by size
+(def ^:dynamic *priority* :newest)
+;; failures of a stage after which a file is quarantined and no longer retried
+(def ^:dynamic *max-failures* 3)
+;; wait before retrying a failed stage, doubled after every failure
+(def ^:dynamic *retry-base-ms* 60000)
+;; quarantined files are moved here with a .error.txt of their last error, nil leaves them in place
+(def ^:dynamic *quarantine-dir* nil)
+;; add every transcription to the full text search index of its directory (.alchemy-search.db), see transcript-index
+(def ^:dynamic *search-index* false)
 
 (def sony-format {:pattern #"(\d{2})(\d{2})(\d{2})_(\d{4})(_\d{2})?\.(wav|mp3|m4a|aac|flac)"
                   :func (fn [[_ yy mm dd tttt num]]
@@ -22,87 +67,616 @@
   (when *verbose*
     (apply println args)))
 
-(defn run-x-times
-  "Takes in a function and sequence of inputes for that function.
-   It runs the function on each element of the sequence or until it reaches max successes"
-  [func input-seq success-code max & args]
-  (reduce (fn [acc elem]
-            (if (< acc max)
-              (if (= success-code
-                     (apply func elem args))
-                (+ acc 1) acc)
-              acc))
-          0 input-seq))
+(defn torch-threads
+  "Number of torch threads each worker gets, so the workers together don't oversubscribe the cores."
+  []
+  (or *torch-threads*
+      (max 1 (quot (.availableProcessors (Runtime/getRuntime)) *workers*))))
+
+(defn metrics-summary
+  "Summary of the metrics of run-pool results: the number of requests, the seconds and share of every stage,
+   the median and 95th percentile seconds of a request, the real time factor and the peak memory of the containers.
+   The requests of a words batch share one metrics map, it is counted once."
+  [results]
+  (let [metrics (distinct (keep :metrics results))
+        stage-seconds (apply merge-with + (map :stages metrics))
+        all-stages (reduce + 0 (vals stage-seconds))
+        seconds (vec (sort (map :total_seconds metrics)))
+        percentile (fn [p] (when (seq seconds)
+                             (seconds (min (dec (count seconds)) (int (* p (count seconds)))))))
+        audio-seconds (reduce + 0 (keep :audio_seconds metrics))
+        timed-seconds (reduce + 0 (map :total_seconds (filter :audio_seconds metrics)))]
+    {:requests (count metrics)
+     :stage-seconds stage-seconds
+     :stage-share (into {} (map (fn [[stage s]] [stage (if (pos? all-stages) (/ s all-stages) 0)])) stage-seconds)
+     :p50-seconds (percentile 0.5)
+     :p95-seconds (percentile 0.95)
+     :audio-seconds audio-seconds
+     :rtf (when (pos? audio-seconds) (/ timed-seconds audio-seconds))
+     :peak-rss-mb (reduce max 0 (keep :peak_rss_mb metrics))}))
+
+(defn run-pool
+  "Runs jobs on a pool of *workers* batch containers, each container gets torch-threads threads.
+   Jobs are sent to a container *batch-size* at a time, so they can be decoded together.
+   handle is called with the result of every job and returns SUCCESS when the job succeeded.
+   When handle throws it is called again with the result turned into a failure with the exception as :error,
+   so the file is counted as failed and retried with backoff like a failed request.
+   A container that exits fails its jobs with :container-error, handle isn't called for them and the worker stops,
+   so an outage doesn't count against the files. They are left for the next run.
+   No new jobs are handed out once max jobs succeeded, failed jobs don't count towards max.
+   Returns a vector of the job results, in order of completion, with :status :success or :failure.
+   With *metrics* every result has the :metrics of its request, see metrics-summary."
+  [jobs handle max opts]
+  (let [remaining (atom (seq jobs))
+        next-job! (fn [] (first (first (swap-vals! remaining next))))
+        ;; successes plus jobs in flight
+        claimed (atom 0)
+        claim! (fn [] (< (first (swap-vals! claimed #(if (< % max) (inc %) %))) max))
+        take-jobs! (fn []
+                     (loop [taken []]
+                       (if (and (< (count taken) *batch-size*) (claim!))
+                         (if-let [job (next-job!)]
+                           (recur (conj taken job))
+                           (do (swap! claimed dec) taken))
+                         taken)))
+        results (atom [])
+        worker-opts (concat opts
+                            ["--threads" (str (torch-threads)) "--batch-size" (str *batch-size*)]
+                            (when *metrics* ["--metrics"]))
+        run-handle (fn [result]
+                     (let [status (when-not (:container-error result)
+                                    (try (handle result)
+                                         (catch Exception e
+                                           (verbose-print "Failed handling " (fs/file-name (:file result)) ": " (ex-message e))
+                                           (try (handle (assoc result :ok false :error (ex-message e)))
+                                                (catch Exception _ nil)))))
+                           success? (= SUCCESS status)]
+                       (when-not success? (swap! claimed dec))
+                       (swap! results conj (assoc result :status (if success? :success :failure)))))
+        work (fn []
+               (let [worker (apply rp/start-batch-worker (map :file jobs) worker-opts)]
+                 (try
+                   (loop []
+                     (let [taken (take-jobs!)]
+                       (when (seq taken)
+                         (let [batch-results (rp/run-batch-jobs worker taken)]
+                           (run! run-handle batch-results)
+                           (if (some :container-error batch-results)
+                             (println "Batch container exited, stopping its worker, the remaining files are left for the next run")
+                             (recur))))))
+                   (finally (rp/stop-batch-worker worker)))))]
+    (->> (repeatedly (min *workers* (count jobs)) #(future (work)))
+         doall
+         (run! deref))
+    (when *metrics*
+      (println "Metrics summary:" (json/generate-string (metrics-summary @results) {:pretty true})))
+    @results))
+
+(defn- words-opts
+  "Whispering alchemy options used to get the first words of a recording."
+  []
+  (cond-> []
+    *lang* (conj "--lang" *lang*)
+    *precision* (conj "--precision" *precision*)
+    *max-words* (conj "--get-words" (str *max-words*))
+    *words-window* (conj "--words-window" (str *words-window*))
+    *verbose* (conj "-v")))
+
+(defn- transcribe-opts
+  "Whispering alchemy options used to transcribe a recording with model."
+  [model]
+  (cond-> ["--model" model]
+    *lang* (conj "--lang" *lang*)
+    *precision* (conj "--precision" *precision*)
+    *max-words* (conj "--get-words" (str *max-words*))
+    *vad* (conj "--vad")
+    *chunk-workers* (conj "--chunk-workers" (str *chunk-workers*))
+    *cascade-model* (conj "--cascade-model" *cascade-model*)
+    *verbose* (conj "-v")))
+
+(defn- language-file
+  "Returns the path of the file with the detected language of an audio file."
+  [file]
+  (let [[base-name _] (fs/split-ext (fs/file-name file))]
+    (fs/file (fs/parent file) (str base-name ".lang.json"))))
+
+(defn- save-language
+  "Saves the language detected while renaming next to the renamed file, it is only read when *lang* is \"auto\"."
+  [file language]
+  (spit (language-file file) (json/generate-string language)))
+
+(defn detected-language
+  "Returns the language detected for file while renaming, when *lang* is \"auto\" and it was saved."
+  [file]
+  (let [lang-file (language-file file)]
+    (when (and (= "auto" *lang*) (fs/exists? lang-file))
+      (:language (json/parse-string (slurp lang-file) true)))))
+
+(defn new-name-prefix
+  "Returns the prefix of the new name for a file name, or nil when the name doesn't have a supported format."
+  [file-name]
+  (let [convert (fn [{:keys [pattern func]} string]
+                  (let [match (re-matches pattern string)
+                        new-str (if match (func match) nil)]
+                    new-str))]
+    (some identity (map convert (formats-vec) (repeat file-name)))))
+
+(defn- renamed-path
+  "Path of a renamed file in rename-dir, the new name is built from the prefix and the first words of the recording."
+  [file rename-dir prefix words]
+  (let [file-ext (second (fs/split-ext (fs/file-name file)))]
+    (fs/path rename-dir (str prefix (str/join "-" words) "." file-ext))))
+
+(defn- move-renamed
+  "Moves file to rename-dir under its new name, see renamed-path."
+  [file rename-dir prefix words]
+  (let [new-path (renamed-path file rename-dir prefix words)]
+    (fs/move file new-path)
+    (verbose-print "Moved " (fs/file-name file) " -> " (fs/file-name new-path))
+    SUCCESS))
 
 (defn rename-file
   ""
   [file rename-dir]
   (verbose-print "Renaming file: " file)
   (let [file-name (fs/file-name file)
-        file-ext (second (fs/split-ext file-name))
-        convert (fn [{:keys [pattern func]} string]
-                  (let [match (re-matches pattern string)
-                        new-str (if match (func match) nil)]
-                    new-str))
-        new-name-prefix (some identity (map convert (formats-vec) (repeat file-name)))
+        new-name-prefix (new-name-prefix file-name)
         bad-format? (nil? new-name-prefix)
-        opts (if *verbose* ["-v"] [])
-        words (if bad-format? nil (apply rp/get-words file opts))
-        new-name (str new-name-prefix (str/join "-" words) "." file-ext)]
+        opts (words-opts)]
     (if bad-format?
       (do (verbose-print "File: " file-name " doesn't have supported format.\n")
           1)
-      (do (fs/move file (fs/path rename-dir new-name))
-          (verbose-print "Moved " file-name " -> " new-name)
-          SUCCESS))))
+      (move-renamed file rename-dir new-name-prefix (apply rp/get-words file opts)))))
+
+(defn- with-index
+  "Calls (f index) with an atom of the index of dir, refreshed to the files in dir, and saves the index afterwards.
+   Without *index* the index starts empty every run and isn't saved."
+  [dir f]
+  (let [index (atom (fi/refresh (if *index* (fi/load-index dir) {}) dir))]
+    (try
+      (f index)
+      (finally
+        (when *index* (fi/save-index dir @index))))))
+
+(defn- settled?
+  "Checks if an indexed file wasn't written to for *settle-ms*."
+  [{:keys [mtime]}]
+  (< mtime (- (System/currentTimeMillis) *settle-ms*)))
+
+(defn- ready?
+  "Checks if stage can run on an indexed file: it settled, isn't quarantined and isn't waiting for a retry."
+  [entry stage]
+  (and (settled? entry)
+       (not (:quarantined entry))
+       (<= (get-in entry [:retry-at stage] 0) (System/currentTimeMillis))))
+
+(defn- by-priority
+  "Returns the entries of index in the order of *priority*."
+  [index]
+  (let [[k order] (case *priority*
+                    :newest [:mtime >]
+                    :oldest [:mtime <]
+                    :smallest [:size <]
+                    :largest [:size >])]
+    (sort-by (comp k val) order index)))
+
+(defn- quarantine!
+  "Moves a file that keeps failing to *quarantine-dir* next to a .error.txt with its last error.
+   Without *quarantine-dir* the file stays in place, the index keeps it from being retried."
+  [index file stage error]
+  (verbose-print "Quarantining " (fs/file-name file) " after " *max-failures* " failures")
+  (if *quarantine-dir*
+    (let [[base-name ext] (fs/split-ext (fs/file-name file))
+          target (->> (range)
+                      (map #(fs/path *quarantine-dir* (if (zero? %) (fs/file-name file) (str base-name "_" % "." ext))))
+                      (remove fs/exists?)
+                      first)]
+      (fs/create-dirs *quarantine-dir*)
+      (fs/move file target)
+      (spit (str target ".error.txt") (str stage ": " error "\n"))
+      (swap! index dissoc (fi/file-key file)))
+    (swap! index assoc-in [(fi/file-key file) :quarantined] stage)))
+
+(defn- fail!
+  "Counts a failed stage of file in index and schedules its retry with exponential backoff.
+   After *max-failures* failures of the stage the file is quarantined."
+  [index file stage error]
+  (let [k (fi/file-key file)
+        failures (get-in (swap! index update-in [k :failed stage] (fnil inc 0)) [k :failed stage])]
+    (if (>= failures *max-failures*)
+      (quarantine! index file stage error)
+      (swap! index assoc-in [k :retry-at stage]
+             (+ (System/currentTimeMillis) (* *retry-base-ms* (bit-shift-left 1 (dec failures))))))))
+
+(defn- rename-jobs
+  "Returns the jobs with output for the files in index that have a supported name and are ready to be renamed,
+   in the order of *priority*. The new name prefix of every file is kept in the index, so names are only matched once."
+  [index output]
+  (->> (by-priority @index)
+       (keep (fn [[k entry]]
+               (when (ready? entry :rename)
+                 (if (contains? entry :prefix)
+                   (when-let [prefix (:prefix entry)]
+                     {:file (fs/path k) :prefix prefix :output output})
+                   (let [prefix (new-name-prefix (fs/file-name k))]
+                     (swap! index assoc-in [k :prefix] prefix)
+                     (if prefix
+                       {:file (fs/path k) :prefix prefix :output output}
+                       (verbose-print "File: " (fs/file-name k) " doesn't have supported format.\n")))))))
+       vec))
 
 (defn process-intake
-  "Runs rename-file on all files in a specific directory. Moves them to the rename-dir specified.
-   When max is specified, only 'max' transcriptions will occur otherwise max is 100."
+  "Renames all files in a specific directory and moves them to the rename-dir specified.
+   The files are renamed by a pool of *workers* containers.
+   When max is specified, only 'max' renames will occur otherwise max is 100.
+   Returns the result of every renamed file, see run-pool."
   ([intake-dir] (process-intake intake-dir intake-dir))
   ([intake-dir rename-dir] (process-intake intake-dir rename-dir 100))
   ([intake-dir rename-dir max]
-   (run-x-times rename-file (fs/list-dir intake-dir) SUCCESS max rename-dir)))
+   (with-index
+     intake-dir
+     (fn [index]
+       (let [jobs (rename-jobs index "words")
+             opts (words-opts)
+             rename (fn [{:keys [file prefix ok result error language]}]
+                      (if ok
+                        (let [status (move-renamed file rename-dir prefix result)]
+                          (swap! index dissoc (fi/file-key file))
+                          (when (and language (= "auto" *lang*))
+                            (save-language (renamed-path file rename-dir prefix result) language))
+                          status)
+                        (do (fail! index file :rename error)
+                            (verbose-print "Failed renaming file: " (fs/file-name file) " " error))))]
+         (run-pool jobs rename max opts))))))
+
+(defn- transcription-file
+  "Returns the path of the transcription file of an audio file for the given model."
+  [file model]
+  (let [[base-name _] (fs/split-ext (fs/file-name file))]
+    (fs/file (fs/parent file) (str base-name "." model ".txt"))))
+
+(defn- audio-file?
+  "Checks if file has the extension of a supported audio format."
+  [file]
+  (let [[_ ext] (fs/split-ext (fs/file-name file))]
+    (boolean (some #(= % ext) ["mp3" "wav" "m4a" "aac" "flac"]))))
+
+(defn- good-size?
+  "Checks if a file of file-size bytes is within the size limits of a transcription,
+   there is no upper limit with *chunk-workers*."
+  [file-size]
+  (boolean (and (> file-size *min-file-size*)
+                (or *chunk-workers* (< file-size *max-file-size*)))))
+
+(defn transcribe?
+  "Checks if a file is an audio file that should be transcribed with the given model.
+   Prints the reason an audio file is skipped."
+  [file model]
+  (let [file-name (fs/file-name file)
+        audio? (audio-file? file)
+        trans-exists? (fs/exists? (transcription-file file model))
+        good-size? (good-size? (fs/size file))]
+    (when audio?
+      (verbose-print "Transcribing file: " file-name)
+      (cond
+        trans-exists?    (verbose-print "Transcription exists ... skipping")
+        (not good-size?) (verbose-print "File is to small or to big ... skipping")))
+    (boolean (and audio? (not trans-exists?) good-size?))))
+
+(defn- transcription-output
+  "Output mode of transcription requests, json when the search index needs the segment timestamps."
+  [text-output json-output]
+  (if *search-index* json-output text-output))
+
+(defn- transcription-text
+  "Returns the text of a transcription result, a json result or its text."
+  [result]
+  (if (map? result) (:text result) result))
+
+(defn- index-transcription
+  "Adds the transcription of file by model to the search index of its directory when *search-index* is true.
+   The segments of a json result are written to a .json sidecar first, so reindexing keeps their timestamps.
+   Failures are only printed, the transcription is already written and the next reindex picks it up."
+  [file model result]
+  (when *search-index*
+    (try
+      (when (seq (:segments result))
+        (spit (str (ti/sidecar file model "json"))
+              (json/generate-string {:segments (map #(select-keys % [:start :end :text]) (:segments result))})))
+      (ti/index-transcript! file model)
+      (catch Exception e
+        (verbose-print "Failed indexing transcription of " (fs/file-name file) ": " (ex-message e))))))
+
+(defn- stream-transcription
+  "Transcribes file with streamed output. Segments are appended to a .part file next to out-file-path
+   as they are decoded, which replaces out-file-path once the transcription is done.
+   Returns the segments."
+  [file out-file-path opts]
+  (let [part-file (fs/file (str out-file-path ".part"))
+        segments (atom [])
+        on-line (fn [{:keys [type text seconds total_seconds] :as line}]
+                  (case type
+                    "segment" (do (spit part-file text :append true)
+                                  (swap! segments conj line))
+                    "progress" (verbose-print "Transcribed " seconds "s of " total_seconds "s of " (fs/file-name file))
+                    nil))]
+    (spit part-file "")
+    (let [done (apply rp/transcribe-audio-stream file on-line opts)]
+      (spit part-file (str (:text done) "\n"))
+      (fs/move part-file out-file-path {:replace-existing true})
+      {:segments @segments})))
 
 (defn transcribe-file
-  "Transcribe a given file with the given model using whisper AI."
+  "Transcribe a given file with the given model using whisper AI.
+   When *stream* is true the transcription is written while it progresses, see stream-transcription.
+   Streamed chunks are transcribed in order, so *stream* can't be combined with *chunk-workers*."
   ([file] (transcribe-file file "base"))
   ([file model]
-   (let [file-name (fs/file-name file)
-         file-dir (fs/parent file)
-         [base-name ext] (fs/split-ext file-name)
-         out-file (str base-name "." model ".txt")
-         out-file-path (fs/file file-dir out-file)
-         audio? (some #(= % ext) ["mp3" "wav" "m4a" "aac" "flac"])
-         trans-exists? (fs/exists? out-file-path)
-         ;; todo get rid of magic numbers
-         file-size (fs/size file)
-         good-size? (and (> file-size *min-file-size*) 
-                         (< file-size *max-file-size*))
-         do-trans? (and audio? (not trans-exists?) good-size?)
-         opts (cond-> ["--model" model]
-                *verbose* (conj "-v"))]
-     (when audio?
-       (verbose-print "Transcribing file: " file-name)
-       (cond
-         trans-exists?    (verbose-print "Transcription exists ... skipping")
-         (not good-size?) (verbose-print "File is to small or to big ... skipping")))
-     (when do-trans?
-       (spit out-file-path (apply rp/transcribe-audio file opts))
-       (verbose-print "Transcribed file: " file-name " to " out-file)
+   (when (and *stream* *chunk-workers*)
+     (throw (ex-info "*stream* can't be combined with *chunk-workers*" {:file file})))
+   (let [out-file-path (transcription-file file model)
+         opts (concat (transcribe-opts model)
+                      (when-let [language (detected-language file)] ["--lang" language]))]
+     (when (transcribe? file model)
+       (if *stream*
+         (index-transcription file model (stream-transcription file out-file-path opts))
+         (binding [rp/*on-metrics* (when *metrics*
+                                     #(println "Metrics of" (fs/file-name file) (json/generate-string %)))]
+           (let [out (apply rp/transcribe-audio file (concat opts ["--output" (transcription-output "text" "json")]))
+                 result (if *search-index* (json/parse-string out true) out)]
+             (spit out-file-path (if *search-index* (str (:text result) "\n") out))
+             (index-transcription file model result))))
+       (verbose-print "Transcribed file: " (fs/file-name file) " to " (fs/file-name out-file-path))
        SUCCESS))))
 
+(defn process-intake-transcribe
+  "Renames all files in a specific directory, moves them to rename-dir and writes their transcription
+   with the given model next to them. Every file is decoded and transcribed once for both steps.
+   Files outside the size limits of a transcription (see transcribe?) are only renamed.
+   When max is specified, only 'max' files are processed.
+   Returns the result of every processed file, see run-pool."
+  ([intake-dir model] (process-intake-transcribe intake-dir intake-dir model))
+  ([intake-dir rename-dir model] (process-intake-transcribe intake-dir rename-dir model 100))
+  ([intake-dir rename-dir model max]
+   (with-index
+     intake-dir
+     (fn [index]
+       (let [jobs (mapv #(if (good-size? (fs/size (:file %))) % (assoc % :output "words"))
+                         (rename-jobs index (transcription-output "words+text" "words+json")))
+             opts (transcribe-opts model)
+             rename-transcribe (fn [{:keys [file prefix ok result error output]}]
+                                 (cond
+                                   (and ok (= "words" output))
+                                   (let [status (move-renamed file rename-dir prefix result)]
+                                     (swap! index dissoc (fi/file-key file))
+                                     status)
+
+                                   ok
+                                   (let [{:keys [words transcription]} result
+                                         new-path (renamed-path file rename-dir prefix words)
+                                         out-file-path (transcription-file new-path model)]
+                                     (fs/move file new-path)
+                                     (swap! index dissoc (fi/file-key file))
+                                     (spit out-file-path (str (transcription-text transcription) "\n"))
+                                     (index-transcription new-path model transcription)
+                                     (verbose-print "Moved " (fs/file-name file) " -> " (fs/file-name new-path)
+                                                    " and transcribed to " (fs/file-name out-file-path))
+                                     SUCCESS)
+
+                                   :else
+                                   (do (fail! index file :rename error)
+                                       (verbose-print "Failed processing file: " (fs/file-name file) " " error))))]
+         (run-pool jobs rename-transcribe max opts))))))
+
+(defn- size-limits
+  "Returns the size limits files are checked against, files rejected under other limits are checked again."
+  []
+  [*min-file-size* *max-file-size* (boolean *chunk-workers*)])
+
+(defn- transcribe-jobs
+  "Returns the transcription jobs of the audio files in index that aren't transcribed with model yet and are ready,
+   in the order of *priority*. Files that aren't audio, already have a transcription or are outside the size limits
+   are marked in the index, so they are only checked once. Transcriptions are looked up among the files of the index,
+   a file whose transcription was deleted is transcribed again."
+  [index model]
+  (let [limits (size-limits)]
+    (->> (by-priority @index)
+         (keep (fn [[k {:keys [audio? transcribed size size-rejected] :as entry}]]
+                 (let [file (fs/path k)
+                       trans-exists? (contains? @index (fi/file-key (transcription-file file model)))]
+                   (when (and (contains? transcribed model) (not trans-exists?))
+                     (swap! index update-in [k :transcribed] disj model))
+                   (cond
+                     (or (false? audio?) (= limits size-rejected) (not (ready? entry model))) nil
+                     (not (audio-file? file)) (do (swap! index assoc-in [k :audio?] false) nil)
+                     trans-exists? (do (swap! index update-in [k :transcribed] (fnil conj #{}) model) nil)
+                     (not (good-size? size)) (do (verbose-print "File " (fs/file-name file) " is to small or to big ... skipping")
+                                                 (swap! index assoc-in [k :size-rejected] limits)
+                                                 nil)
+                     :else (do (verbose-print "Transcribing file: " (fs/file-name file))
+                               (cond-> {:file file :output (transcription-output "text" "json")}
+                                 (detected-language file) (assoc :lang (detected-language file))))))))
+         vec)))
+
 (defn transcribe-all
-  "Runs transcribe file on all file in a specific directory with a given model.
-   When max is specified, only 'max' transcriptions will occur."
+  "Transcribes all files in a specific directory with a given model, using a pool of *workers* containers.
+   When max is specified, only 'max' transcriptions will occur.
+   Returns the result of every transcribed file, see run-pool."
   ;; todo get reid of magic numbers
   ([dir] (transcribe-all dir "base"))
   ([dir model] (transcribe-all dir model 100))
   ([dir model max]
-   (run-x-times transcribe-file (fs/list-dir dir) SUCCESS max model)))
+   (with-index
+     dir
+     (fn [index]
+       (let [jobs (transcribe-jobs index model)
+             opts (transcribe-opts model)
+             write (fn [{:keys [file ok result error]}]
+                     (if ok
+                       (let [out-file-path (transcription-file file model)]
+                         (spit out-file-path (str (transcription-text result) "\n"))
+                         (index-transcription file model result)
+                         (swap! index update-in [(fi/file-key file) :transcribed] (fnil conj #{}) model)
+                         (verbose-print "Transcribed file: " (fs/file-name file) " to " (fs/file-name out-file-path))
+                         SUCCESS)
+                       (do (fail! index file model error)
+                           (verbose-print "Failed transcribing file: " (fs/file-name file) " " error))))]
+         (run-pool jobs write max opts))))))
+
+(defn- next-retry
+  "Returns the earliest time in epoch milliseconds a failed file in the index of dir is retried, nil when none is
+   waiting for a retry."
+  [dir]
+  (when *index*
+    (let [now (System/currentTimeMillis)
+          retries (for [[_ entry] (fi/load-index dir)
+                        :when (not (:quarantined entry))
+                        [_ retry-at] (:retry-at entry)
+                        :when (> retry-at now)]
+                    retry-at)]
+      (when (seq retries) (apply min retries)))))
+
+(defn watch-intake
+  "Watches intake-dir and renames and transcribes new files with model as they arrive, see process-intake-transcribe.
+   Failed files are retried once their backoff ends. Blocks until interrupted."
+  [intake-dir rename-dir model]
+  (fi/watch intake-dir *settle-ms* #(do (process-intake-transcribe intake-dir rename-dir model Integer/MAX_VALUE)
+                                        (next-retry intake-dir))))
+
+(defn watch-transcribe
+  "Watches dir and transcribes new audio files with model as they arrive, see transcribe-all.
+   Failed files are retried once their backoff ends. Blocks until interrupted."
+  [dir model]
+  (fi/watch dir *settle-ms* #(do (transcribe-all dir model Integer/MAX_VALUE)
+                                 (next-retry dir))))
+
+(defn- base-name
+  "Returns the name of file up to its first dot, the name its sidecar files (transcriptions, language) start with."
+  [file]
+  (first (str/split (str (fs/file-name file)) #"\." 2)))
+
+(defn- transcript-unavailable?
+  "Checks if an indexed file won't get a transcription by model: it's outside the size limits or transcribing it
+   with model kept failing."
+  [entry model]
+  (or (= (size-limits) (:size-rejected entry))
+      (= model (:quarantined entry))))
+
+(defn- sort-jobs
+  "Returns the recordings in index that have a renamed name, are ready and match one of rules, in the order of
+   *priority*, with their sidecar files and the transcript of model.
+   Recordings no rule matches are marked in the index with a key of the rules and their sidecar files,
+   so they are only matched again once either changes. Recordings matching a logseq tag with :transcribe
+   wait until their transcription by model exists, so it can be linked from the journal, unless they won't get
+   one, see transcript-unavailable?, then they are sorted without it."
+  [index rules rules-key model]
+  (let [sidecars (group-by base-name (map fs/path (keys @index)))]
+    (->> (by-priority @index)
+         (keep (fn [[k entry]]
+                 (let [file (fs/path k)
+                       parsed (sorting/parse-name (str (fs/file-name file)))
+                       side (remove #{file} (get sidecars (base-name file)))
+                       unsorted-key (hash [rules-key (sort (map str side))])]
+                   (when (and parsed
+                              ;; a failed transcription doesn't keep a recording from being sorted
+                              (ready? (cond-> entry (= model (:quarantined entry)) (dissoc :quarantined)) :sort)
+                              (not= unsorted-key (:unsorted entry)))
+                     (let [transcript-file (fs/path (transcription-file file model))
+                           transcript (when (some #{transcript-file} side) (str/trim (slurp (str transcript-file))))]
+                       (if-let [rule (sorting/match-rule rules parsed transcript)]
+                         (if (and (= :logseq (:kind rule)) (:transcribe rule) (nil? transcript)
+                                  (not (transcript-unavailable? entry model)))
+                           (verbose-print "Waiting for the " model " transcription of " (fs/file-name file) " to sort it")
+                           {:file file :parsed parsed :sidecars side :rule rule :transcript transcript})
+                         (do (swap! index assoc-in [k :unsorted] unsorted-key) nil)))))))
+         vec)))
+
+(defn- move-sorted
+  "Moves file to dir under a free name from the destination index, its sidecar files follow under the new base name.
+   Returns the new path of file."
+  [destinations file sidecars dir]
+  (let [new-name (sorting/claim-name! destinations dir (str (fs/file-name file)))
+        new-base (base-name new-name)]
+    (fs/move file (fs/path dir new-name))
+    (doseq [sidecar sidecars
+            :let [sidecar-name (str new-base (subs (str (fs/file-name sidecar)) (count (base-name file))))]]
+      (sorting/add-name! destinations dir sidecar-name)
+      (fs/move sidecar (fs/path dir sidecar-name)))
+    (fs/path dir new-name)))
+
+(defn sort-files
+  "Sorts the renamed recordings in sort-dir with the rules of config, see sorting/compile-rules.
+   Recordings matching a folder rule are moved to its :dir along with their sidecar files. Recordings matching a
+   logseq tag are moved to the logseq assets and linked from their journal page with their transcription by model,
+   their sidecar files get a .used suffix.
+   Rules are compiled once and destination directories are listed at most once per run through an index of them,
+   journal pages are appended to after all recordings moved, with one write per page.
+   Returns the sorted recordings with the :name of their rule and their :path."
+  ([sort-dir config] (sort-files sort-dir config "base"))
+  ([sort-dir config model]
+   (let [rules (sorting/compile-rules config)
+         rules-key (hash (select-keys config [:sorting :folders :logseq :tags]))
+         {:keys [logseq-dir intake-tag max-transcription-len]
+          :or {intake-tag "📨validate whisper" max-transcription-len 2000}} (:logseq config)
+         destinations (sorting/load-destinations sort-dir)
+         blocks (atom {})
+         sorted (atom [])]
+     (with-index
+       sort-dir
+       (fn [index]
+         (doseq [{:keys [file parsed sidecars rule transcript]} (sort-jobs index rules rules-key model)]
+           (try
+             (let [dir (if (= :folder (:kind rule)) (fs/path (:dir rule)) (fs/path logseq-dir sorting/assets-dir))]
+               (when (= :logseq (:kind rule)) (fs/create-dirs dir))
+               (if-not (fs/directory? dir)
+                 (verbose-print "Directory " dir " doesn't exist, skipping file " (fs/file-name file))
+                 (let [new-path (if (= :folder (:kind rule))
+                                  (move-sorted destinations file sidecars dir)
+                                  (let [path (move-sorted destinations file [] dir)]
+                                    (doseq [sidecar sidecars] (fs/move sidecar (str sidecar ".used")))
+                                    path))]
+                   (when (= :logseq (:kind rule))
+                     (let [transcript (if (> (count transcript) max-transcription-len)
+                                        (verbose-print "Transcription of " (fs/file-name file) " is longer than "
+                                                       max-transcription-len " characters, leaving it out")
+                                        transcript)]
+                       (swap! blocks update (:journal parsed) (fnil conj [])
+                              (sorting/journal-block rule intake-tag (fs/file-name new-path) transcript))))
+                   (swap! index #(apply dissoc % (fi/file-key file) (map fi/file-key sidecars)))
+                   (swap! sorted conj {:file file :name (:name rule) :path new-path})
+                   (verbose-print "Sorted " (fs/file-name file) " -> " new-path))))
+             (catch Exception e
+               (fail! index file :sort (ex-message e))
+               (verbose-print "Failed sorting file: " (fs/file-name file) " " (ex-message e)))))))
+     (when (seq @blocks)
+       (sorting/append-journals destinations logseq-dir @blocks))
+     (sorting/save-destinations sort-dir destinations)
+     @sorted)))
 
-(defn -main []
-  ;rename files
-  ;sort files
-  ;transcribe files in trans dir
-  )
\ No newline at end of file
+(defn -main
+  "Runs the whole pipeline with the edn config file given as the only argument, see exampe-config.edn:
+   renames and transcribes the recordings in :consumer-dir into :pending-sort-dir, transcribes the
+   :pending-transcribe-dirs and sorts :pending-sort-dir. Run with bb -m file-processing config.edn.
+   Throws before processing anything when a model of the config isn't one of model-choices."
+  [config-file]
+  (let [config (edn/read-string (slurp config-file))
+        {:keys [consumer-dir pending-sort-dir pending-transcribe-dirs transcribe-model-mode transcribe-limit
+                verbose disable-transcribe max-words move-unsupported unsupported-dir]} (:app config)
+        model (or transcribe-model-mode "base")
+        sort-model (get-in config [:logseq :logseq-model-mode] model)
+        limit (if (pos? (or transcribe-limit 0)) transcribe-limit 100)]
+    (doseq [m [model sort-model]
+            :when (not (contains? model-choices m))]
+      (throw (ex-info (str "Unsupported model " m ", use one of " (str/join ", " (sort model-choices)))
+                      {:model m})))
+    (binding [*verbose* verbose
+              *max-words* max-words
+              *quarantine-dir* (when move-unsupported unsupported-dir)]
+      (when-not disable-transcribe
+        (process-intake-transcribe consumer-dir pending-sort-dir model limit)
+        (doseq [dir pending-transcribe-dirs
+                :when (fs/directory? dir)]
+          (transcribe-all dir model limit))
+        ;; the index skips recordings that are already transcribed or rejected, so this is cheap when nothing is new
+        (transcribe-all pending-sort-dir sort-model limit))
+      (sort-files pending-sort-dir config sort-model))))
\ No newline at end of file
@@ -1,10 +1,35 @@
 (ns run-podman
   (:require [babashka.process :as p]
             [babashka.fs :as fs]
+            [clojure.java.io :as io]
             [clojure.string :as str]
-            [babashka.pods :as pods]))
+            [cheshire.core :as json]
+            [babashka.pods :as pods])
+  (:import [java.net StandardProtocolFamily UnixDomainSocketAddress]
+           [java.nio.channels Channels SocketChannel]))
 
 (def ^:dynamic *model-dir* (fs/expand-home "~/cvols-local/whisper-model-vol"))
+(def ^:dynamic *run-dir* (fs/expand-home "~/cvols-local/whisper-run"))
+;; directory of the persistent result cache, nil disables the cache
+(def ^:dynamic *cache-dir* nil)
+(def ^:dynamic *use-daemon* false)
+(def ^:dynamic *daemon-retries* 20)
+;; attempts of a daemon request whose connection fails, a container that is down is given up on after them
+(def ^:dynamic *connect-retries* 3)
+;; container pool transcribe-audio sends its requests to when set, see start-pool
+(def ^:dynamic *pool* nil)
+;; jobs after which a pool container is replaced by a fresh one
+(def ^:dynamic *recycle-after* 200)
+;; called with the metrics of every transcribe-audio request when set, containers are run with --metrics.
+;; a daemon only reports metrics when it was started with --metrics
+(def ^:dynamic *on-metrics* nil)
+(def daemon-name "whisper-daemon")
+;; whispering alchemy options that take a value, every other option is a flag
+(def value-options #{"--audio-file-ext" "--get-words" "--words-window" "--lang" "--output" "--stream-chunk-seconds"
+                     "--model" "--precision" "--cascade-model" "--cascade-logprob" "--cascade-compression"
+                     "--cascade-no-speech" "--batch" "--vad-threshold" "--vad-min-silence" "--chunk-workers"
+                     "--chunk-seconds" "--chunk-overlap" "--batch-size" "--batch-max-mb" "--serve" "--queue-size"
+                     "--threads" "--model-cache-mb" "--cache-dir" "--audio-cache-mb" "--cache-max-mb"})
 
 (defn download-models
   "build the podman command that initially downloads all whisper models"
@@ -17,30 +42,457 @@
                  "whisper-cpu" "--download-models"]
          opts))
 
+(defn- cache-volume
+  "podman volume options of the result cache, nil when *cache-dir* isn't set"
+  []
+  (when *cache-dir*
+    (fs/create-dirs *cache-dir*)
+    ["-v" (str *cache-dir* ":/cache-dir:z")]))
+
+(defn- cache-opts
+  "whispering alchemy options of the result cache, nil when *cache-dir* isn't set"
+  []
+  (when *cache-dir* ["--cache-dir" "/cache-dir"]))
+
+(defn- container-name
+  "unique container name, so several containers can run at the same time"
+  []
+  (str "whisper-app-" (subs (str (random-uuid)) 0 8)))
+
 (defn- command
   "build the podman command to be used with process/shell"
   [& opts]
   (apply concat ["podman" "run" "--rm" "-i"
-                 "--name=whisper-app"
+                 (str "--name=" (container-name))
                  "--network" "none"
-                 "-v" (str *model-dir* ":/model-dir:z")
-                 ;"-v" (str tmp-dir ":/app:z")
-                 "--tmpfs" "/app/tmp:size=1G"
-                 "whisper-cpu"]
+                 "-v" (str *model-dir* ":/model-dir:z")]
+         ;"-v" (str tmp-dir ":/app:z")
+         (cache-volume)
+         ["--tmpfs" "/app/tmp:size=1G"
+          "whisper-cpu"]
+         (cache-opts)
          opts))
 
+(defn- batch-command
+  "build the podman command for a batch run, every directory in mounts is mounted read only"
+  [mounts opts]
+  (concat ["podman" "run" "--rm" "-i"
+           (str "--name=" (container-name))
+           "--network" "none"
+           "-v" (str *model-dir* ":/model-dir:z")]
+          (cache-volume)
+          (mapcat (fn [[dir mount]] ["-v" (str dir ":" mount ":ro,z")]) mounts)
+          ["--tmpfs" "/app/tmp:size=1G"
+           "whisper-cpu" "--batch" "-"]
+          (cache-opts)
+          opts))
+
+(defn- mount-points
+  "map the parent directory of each file to a mount point inside the container"
+  [files]
+  (->> files
+       (map #(str (fs/absolutize (fs/parent %))))
+       distinct
+       (map-indexed (fn [i dir] [dir (str "/app/in/" i)]))
+       (into {})))
+
+(defn- container-file
+  "path of a file inside a container with the given mount points"
+  [mounts file]
+  (str (mounts (str (fs/absolutize (fs/parent file)))) "/" (fs/file-name file)))
+
+(defn- manifest-entry
+  "build the manifest json line of a batch job"
+  [id container-file {:keys [output model lang get-words]}]
+  (json/generate-string
+   (cond-> {:id id :file container-file}
+     output (assoc :output output)
+     model (assoc :model model)
+     lang (assoc :lang lang)
+     get-words (assoc :get_words get-words))))
+
+(defn start-batch-worker
+  "start a batch container that takes jobs one at a time, the directories of all files are mounted in it.
+   Returns a worker to be used with run-batch-job and stop-batch-worker."
+  [files & opts]
+  (let [mounts (mount-points files)
+        process (apply p/process {:err :inherit} (batch-command mounts opts))]
+    {:process process
+     :mounts mounts
+     :in (io/writer (:in process))
+     :out (io/reader (:out process))}))
+
+(defn run-batch-jobs
+  "send jobs to a batch worker and wait for their results, the jobs are sent together so the
+   container can decode them as one batch.
+   Returns the jobs merged with :ok :result and :error, words jobs also get the detected :language
+   and every job its :metrics when the worker was started with --metrics.
+   Jobs without a result because the container exited get :container-error, their failure isn't theirs."
+  [{:keys [in out mounts]} jobs]
+  (doseq [job jobs]
+    (.write in (str (manifest-entry 0 (container-file mounts (:file job)) job) "\n")))
+  (.flush in)
+  (mapv (fn [job]
+          (if-let [line (.readLine out)]
+            (merge job (select-keys (json/parse-string line true) [:ok :result :error :language :metrics]))
+            (assoc job :ok false :error "batch container exited" :container-error true)))
+        jobs))
+
+(defn stop-batch-worker
+  "close the job stream of a batch worker and wait for its container to exit"
+  [{:keys [in process]}]
+  (.close in)
+  @process)
+
+(defn daemon-socket
+  "host path of the unix socket the transcription daemon listens on"
+  []
+  (fs/path *run-dir* "alchemize.sock"))
+
+(defn- daemon-command
+  "build the podman command that starts a daemon container called name, listening on a socket in run-dir"
+  [name run-dir opts]
+  (concat ["podman" "run" "-d" "--rm"
+           (str "--name=" name)
+           "--network" "none"
+           "-v" (str *model-dir* ":/model-dir:z")
+           "-v" (str run-dir ":/app/run:z")]
+          (cache-volume)
+          ["--tmpfs" "/app/tmp:size=1G"
+           "whisper-cpu" "--serve" "/app/run/alchemize.sock"]
+          (cache-opts)
+          opts))
+
+(defn start-daemon
+  "start the long running transcription daemon, it keeps the whisper models loaded between requests.
+   The daemon listens on a unix socket in *run-dir* so it works without a container network.
+   Take note of the options from whispering alchemy, e.g. --queue-size."
+  [& opts]
+  (fs/create-dirs *run-dir*)
+  (apply p/shell (daemon-command daemon-name *run-dir* opts)))
+
+(defn stop-daemon
+  "stop the transcription daemon, queued requests are finished before it exits"
+  []
+  (p/shell "podman" "stop" "--time" "300" daemon-name))
+
+(defn snapshot-daemon
+  "checkpoint the running daemon, with its models loaded, to file. The daemon keeps running.
+   restore-daemon starts it again from the snapshot without importing torch or loading models.
+   Needs podman with CRIU support (usually rootful podman)."
+  [file]
+  (p/shell "podman" "container" "checkpoint" "--leave-running" "--export" (str file) daemon-name))
+
+(defn restore-daemon
+  "start the daemon from a snapshot taken with snapshot-daemon, the daemon must not be running"
+  [file]
+  (fs/create-dirs *run-dir*)
+  (p/shell "podman" "container" "restore" "--import" (str file)))
+
+(defn- daemon-request
+  "send a request header and optionally the bytes of an audio file to the daemon listening on socket.
+   The audio is only sent once the daemon answers the header with a continue line, a busy daemon answers
+   right away without reading it.
+   Returns the response map of the daemon."
+  ([socket header] (daemon-request socket header nil))
+  ([socket header file]
+   (with-open [channel (SocketChannel/open StandardProtocolFamily/UNIX)]
+     (.connect channel (UnixDomainSocketAddress/of (str socket)))
+     (let [out (Channels/newOutputStream channel)
+           in (io/reader (Channels/newInputStream channel))
+           header (cond-> header file (assoc :size (fs/size file)))
+           read-response #(if-let [line (.readLine in)]
+                            (json/parse-string line true)
+                            (throw (java.io.IOException. "daemon closed the connection without a response")))]
+       (.write out (.getBytes (str (json/generate-string header) "\n") "UTF-8"))
+       (.flush out)
+       (let [response (read-response)]
+         (if (:continue response)
+           (do (when file (io/copy (fs/file file) out))
+               (.flush out)
+               (read-response))
+           response))))))
+
+(defn daemon-running?
+  "check if the daemon answers on its socket"
+  []
+  (and (fs/exists? (daemon-socket))
+       (try (:ok (daemon-request (daemon-socket) {:type "ping"}))
+            (catch Exception _ false))))
+
+(defn daemon-stats
+  "cache statistics of the daemon, under :model_cache the loaded models, memory, hits, misses, evictions and
+   load time, under :result_cache and :audio_cache the hits, misses and size of the result and decoded audio caches"
+  []
+  (select-keys (daemon-request (daemon-socket) {:type "stats"}) [:model_cache :result_cache :audio_cache]))
+
+(defn- opts->request
+  "turn whispering alchemy command line options into a daemon request header.
+   Only the options in value-options take a value, every other option is a flag and sent as true.
+   The daemon rejects options of its process (precision, vad, ...) rather than ignoring them."
+  [opts]
+  (let [opt-key #(keyword (str/replace (str/replace % #"^-+" "") "-" "_"))]
+    (loop [[opt & more] opts
+           request {}]
+      (cond
+        (nil? opt) request
+        (not (contains? value-options opt)) (recur more (assoc request (opt-key opt) true))
+        :else (recur (rest more) (assoc request (opt-key opt) (first more)))))))
+
+(defn- daemon-transcribe
+  "run a request through the daemon listening on socket, when the daemon queue is full or the connection fails
+   wait and retry. Throws the IOException of the last attempt when the daemon can't be reached.
+   Returns the output the container would have printed."
+  [socket file-path opts]
+  (loop [attempt 1]
+    (let [response (try (daemon-request socket (opts->request opts) file-path)
+                        (catch java.io.IOException e
+                          {:ok false :down e :error (str "connection failed: " (ex-message e))}))]
+      (when (and *on-metrics* (:metrics response))
+        (*on-metrics* (:metrics response)))
+      (cond
+        (:ok response) (:out response)
+        (and (:busy response) (< attempt *daemon-retries*)) (do (Thread/sleep (* 500 attempt))
+                                                                (recur (inc attempt)))
+        (:down response) (if (< attempt *connect-retries*)
+                           (do (Thread/sleep (* 500 attempt)) (recur (inc attempt)))
+                           (throw (:down response)))
+        :else (throw (ex-info (str "daemon request failed: " (:error response))
+                              {:file file-path :response response}))))))
+
+(defn- pool-member-ready?
+  "check if a pool container answers on its socket"
+  [{:keys [socket]}]
+  (and (fs/exists? socket)
+       (try (:ok (daemon-request socket {:type "ping"}))
+            (catch Exception _ false))))
+
+(defn- start-pool-member
+  "start a daemon container for a pool, with its own name, run directory and tmpfs.
+   Waits until it answers and has loaded models, then returns the pool member."
+  [models opts]
+  (let [name (container-name)
+        run-dir (fs/path *run-dir* name)
+        member {:name name :run-dir run-dir :socket (fs/path run-dir "alchemize.sock") :jobs 0}]
+    (fs/create-dirs run-dir)
+    (apply p/shell {:out :string} (daemon-command name run-dir opts))
+    (loop [attempt 1]
+      (when-not (pool-member-ready? member)
+        (if (< attempt (* 4 *daemon-retries*))
+          (do (Thread/sleep 500) (recur (inc attempt)))
+          (throw (ex-info (str "pool container didn't start: " name) member)))))
+    (doseq [model models]
+      (daemon-request (:socket member) {:type "warm" :model model}))
+    member))
+
+(defn- stop-pool-member
+  "stop a pool container, its queued requests are finished first, and remove its run directory"
+  [{:keys [name run-dir]}]
+  (p/shell {:continue true :out :string :err :string} "podman" "stop" "--time" "300" name)
+  (fs/delete-tree run-dir))
+
+(defn start-pool
+  "start size daemon containers that keep the models loaded between requests, every model in models is loaded
+   before the pool is returned. Bind *pool* to the pool so transcribe-audio dispatches requests to idle containers.
+   Containers are replaced after *recycle-after* jobs or when they stop answering.
+   Take note of the options from whispering alchemy, e.g. --model-cache-mb."
+  [size models & opts]
+  (let [members (->> (repeatedly size #(future (start-pool-member models opts)))
+                     doall
+                     (mapv deref))]
+    {:idle (atom (apply list members))
+     :members (atom (into {} (map (juxt :name identity)) members))
+     :models models
+     :opts opts}))
+
+(defn stop-pool
+  "stop every container of a pool"
+  [{:keys [members]}]
+  (->> (vals @members)
+       (map #(future (stop-pool-member %)))
+       doall
+       (run! deref)))
+
+(defn- checkout!
+  "take an idle container from the pool, waits until one is idle.
+   Throws when the pool has no containers left, they all failed to be replaced."
+  [{:keys [idle members]}]
+  (loop []
+    (if-let [member (first (first (swap-vals! idle #(if (seq %) (pop %) %))))]
+      member
+      (if (empty? @members)
+        (throw (ex-info "no pool containers left, replacing them failed" {}))
+        (do (Thread/sleep 50) (recur))))))
+
+(defn- replace-member!
+  "replace a pool container by a fresh one, the old container is stopped in the background.
+   Returns the new member."
+  [{:keys [members models opts]} member]
+  (let [fresh (start-pool-member models opts)]
+    (swap! members #(-> % (dissoc (:name member)) (assoc (:name fresh) fresh)))
+    (future (stop-pool-member member))
+    fresh))
+
+(defn- replace-later!
+  "replace a pool container in the background, the fresh container becomes idle once it is ready.
+   A failed start is retried up to *connect-retries* times, after that the container is stopped and
+   the pool goes on without it."
+  [{:keys [idle members] :as pool} member]
+  (future
+    (loop [attempt 1]
+      (let [fresh (try (replace-member! pool member)
+                       (catch Exception e
+                         (binding [*out* *err*]
+                           (println "Failed replacing pool container" (:name member) "attempt" attempt ":" (ex-message e)))
+                         nil))]
+        (cond
+          fresh (swap! idle conj fresh)
+          (< attempt *connect-retries*) (do (Thread/sleep (* 5000 attempt)) (recur (inc attempt)))
+          :else (do (swap! members dissoc (:name member))
+                    (stop-pool-member member)))))))
+
+(defn- checkin!
+  "give a container back to the pool after a job, it is recycled once it ran *recycle-after* jobs"
+  [{:keys [idle members] :as pool} member]
+  (let [member (update member :jobs inc)]
+    (swap! members assoc (:name member) member)
+    (if (>= (:jobs member) *recycle-after*)
+      (replace-later! pool member)
+      (swap! idle conj member))))
+
+(defn check-pool
+  "health check of the idle containers of a pool, containers that don't answer are replaced in the background,
+   see replace-later!.
+   Returns the number of replaced containers."
+  [{:keys [idle] :as pool}]
+  (let [members (first (swap-vals! idle empty))
+        {healthy true down false} (group-by pool-member-ready? members)]
+    (swap! idle into healthy)
+    (run! #(replace-later! pool %) down)
+    (count down)))
+
+(defn pool-stats
+  "the number of jobs and the cache statistics of every container in a pool, see daemon-stats"
+  [{:keys [members]}]
+  (for [{:keys [name socket jobs]} (vals @members)]
+    (merge {:name name :jobs jobs}
+           (try (select-keys (daemon-request socket {:type "stats"}) [:model_cache :result_cache :audio_cache])
+                (catch Exception e {:error (ex-message e)})))))
+
+(defn- pool-transcribe
+  "run a request on an idle container of the pool. A container that can't be reached is replaced
+   and the request is retried once on another container."
+  [pool file-path opts]
+  (loop [attempt 1]
+    (let [member (checkout! pool)
+          outcome (try
+                    {:out (daemon-transcribe (:socket member) file-path opts)}
+                    (catch java.io.IOException e {:down e})
+                    (catch Exception e {:error e}))]
+      (cond
+        (:down outcome) (do (replace-later! pool member)
+                            (if (< attempt 2)
+                              (recur (inc attempt))
+                              (throw (:down outcome))))
+        :else (do (checkin! pool member)
+                  (if (:error outcome) (throw (:error outcome)) (:out outcome)))))))
+
+(defn- print-err
+  "print the stderr of a container, its metrics line is passed to *on-metrics* instead"
+  [err]
+  (let [metrics-line? #(str/starts-with? % "{\"metrics\"")
+        lines (str/split-lines err)]
+    (when *on-metrics*
+      (doseq [line (filter metrics-line? lines)]
+        (*on-metrics* (:metrics (json/parse-string line true)))))
+    (println (str/join "\n" (remove metrics-line? lines)))))
+
 (defn transcribe-audio
   "takes in a file path of an audio file and runs it through whispering alchemy container
    This function will return the stdout of the container and print the stderr to console
+   When *pool* is bound the request goes to an idle container of the pool, otherwise when *use-daemon*
+   is true the request is sent to the running daemon instead of a new container.
+   When *on-metrics* is set it is called with the metrics of the request.
    Take note of the options from whispering alchemy."
   [file-path & opts]
   (let [file-ext (fs/extension file-path)
-        new-opts (concat opts ["--audio-file-ext" file-ext])
-        process-opts {:in (fs/file file-path) :out :string :err :string}
-        command-vec (command new-opts)
-        process (apply p/shell process-opts command-vec)]
+        new-opts (concat opts ["--audio-file-ext" file-ext] (when *on-metrics* ["--metrics"]))]
+    (cond
+      *pool* (pool-transcribe *pool* file-path new-opts)
+      *use-daemon* (daemon-transcribe (daemon-socket) file-path new-opts)
+      :else
+      (let [process-opts {:in (fs/file file-path) :out :string :err :string}
+            command-vec (command new-opts)
+            process (apply p/shell process-opts command-vec)]
+        (print-err (:err process))
+        (:out process)))))
+
+(defn transcribe-audio-stream
+  "like transcribe-audio, but the container writes jsonl output that is read while it transcribes.
+   on-line is called with every parsed line as it arrives: the segments, the progress after every chunk
+   and the final done line with the full text. The daemon isn't used for streamed transcriptions.
+   Returns the done line."
+  [file-path on-line & opts]
+  (let [file-ext (fs/extension file-path)
+        new-opts (concat opts ["--output" "jsonl" "--audio-file-ext" file-ext])
+        process (apply p/process {:in (fs/file file-path) :err :inherit} (command new-opts))
+        done (with-open [out (io/reader (:out process))]
+               (reduce (fn [done line]
+                         (let [message (json/parse-string line true)]
+                           (on-line message)
+                           (if (= "done" (:type message)) message done)))
+                       nil
+                       (remove str/blank? (line-seq out))))]
+    (p/check process)
+    done))
+
+(defn- benchmark-command
+  "build the podman command running the benchmark script on files, the directories of the files are mounted read only"
+  [files args]
+  (let [mounts (mount-points files)]
+    (concat ["podman" "run" "--rm"
+             (str "--name=" (container-name))
+             "--network" "none"
+             "-v" (str *model-dir* ":/model-dir:z")]
+            (mapcat (fn [[dir mount]] ["-v" (str dir ":" mount ":ro,z")]) mounts)
+            ["--tmpfs" "/app/tmp:size=1G"
+             "--entrypoint" "python3"
+             "whisper-cpu" "./scripts/benchmark.py"]
+            (args (partial container-file mounts)))))
+
+(defn benchmark-precision
+  "transcribes files with a model in every inference precision and compares them to fp32,
+   a <name>.txt next to a file is used as its reference transcript.
+   Returns the benchmark report with the speedup and word error rate of every precision."
+  [files & opts]
+  (let [process (apply p/shell {:out :string :err :string}
+                       (benchmark-command files #(concat ["precision"] (map % files) opts)))]
+    (println (:err process))
+    (json/parse-string (:out process) true)))
+
+(defn benchmark-startup
+  "times the startup of whispering alchemy in a container: --help, a bad argument, importing torch and whisper,
+   loading a model with whisper.load_model and from its verified checkpoint, and a cold words request.
+   Returns the benchmark report."
+  [& opts]
+  (let [process (apply p/shell {:out :string :err :string}
+                       (benchmark-command [] #(concat ["startup"] opts)))]
+    (println (:err process))
+    (json/parse-string (:out process) true)))
+
+(defn benchmark-stages
+  "times every stage of the pipeline (model load, ffmpeg decode, mel, encoder, decoder and end to end)
+   for the models in opts, on files or on synthetic fixtures when files is empty.
+   With a baseline report, stages slower than the baseline are listed under :regressions.
+   Returns the benchmark report."
+  [files baseline & opts]
+  (let [process (apply p/shell {:out :string :err :string :continue true}
+                       (benchmark-command (cond-> (vec files) baseline (conj baseline))
+                                          #(concat ["stages"] (map % files)
+                                                   (when baseline ["--baseline" (% baseline)])
+                                                   opts)))]
     (println (:err process))
-    (:out process)))
+    (json/parse-string (:out process) true)))
 
 (defn get-words
   "Get the first few words of an audio file.
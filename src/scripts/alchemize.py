@@ -3,53 +3,989 @@ import sys
 import re
 import datetime
 import argparse
-import whisper
+import time
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib
+import itertools
+import multiprocessing
+import shutil
+import subprocess
 import json
+import queue
+import resource
+import signal
+import socket
+import tempfile
+import threading
+
+class LazyModule:
+    """
+    Module imported on first use. torch and whisper take seconds to import, paths that never load a model
+    (--help, bad arguments, cached results) don't pay for them.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+np = LazyModule("numpy")
+torch = LazyModule("torch")
+whisper = LazyModule("whisper")
+
+# SAMPLE_RATE and CHUNK_LENGTH, defined here so whisper isn't imported to read them
+SAMPLE_RATE = 16000
+CHUNK_LENGTH = 30
 
 models = "/model-dir"
+tmp_dir = "/app/tmp"
+model_choices = ["tiny", "tiny.en", "base", "base.en", "small", "small.en", "medium.en", "turbo"]
+output_choices = ["words", "text", "json", "words+text", "words+json"]
+# segments written as json lines while transcribing, only for a single file on stdin
+stream_output = "jsonl"
+# containers ffmpeg can only decode from a seekable file
+seekable_exts = ["m4a", "mp4", "mov", "3gp"]
+# seconds at the start of a recording that words mode decodes
+words_window = CHUNK_LENGTH
+# voice activity detection settings of get_transcription, None transcribes the whole audio
+vad_options = None
+# recordings longer than a chunk are split at silences and transcribed by a process pool, None disables chunking
+chunk_options = None
+# precision of cpu inference, int8 quantizes the linear layers and bf16 runs them in bfloat16
+precision_choices = ["fp32", "int8", "bf16"]
+precision = "fp32"
+# header keys of a daemon request, every other option is set when the daemon starts
+request_keys = {"type", "id", "size", "model", "output", "get_words", "lang", "audio_file_ext"}
+# options a client may send along that don't change a result
+ignored_request_keys = {"v", "verbose", "metrics"}
+# collect the stage timings of every request, see Metrics
+collect_metrics = False
+# weak segments of a transcription are transcribed again with a larger model, None disables the cascade
+cascade_options = None
+
+
+
+class Metrics:
+    """
+    Seconds spent in each stage of a request, with the seconds of audio it decoded and the peak memory of the process.
+
+    Stages are added with the stage context manager on the thread running the request, see start_metrics.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = collections.defaultdict(float)
+        self.audio_seconds = None
+
+    def add(self, name, seconds):
+        self.stages[name] += seconds
+
+    def as_dict(self):
+        total = time.perf_counter() - self.start
+        return {"stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                "total_seconds": round(total, 4),
+                "audio_seconds": self.audio_seconds,
+                "rtf": round(total / self.audio_seconds, 4) if self.audio_seconds else None,
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+
+request_metrics = threading.local()
+
+
+def start_metrics(metrics=None):
+    """Collect the metrics of a request on this thread, returns them or None when metrics aren't collected."""
+    request_metrics.current = (metrics or Metrics()) if collect_metrics else None
+    return request_metrics.current
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time spent in the block to the stage name of the metrics of the current request."""
+    metrics = getattr(request_metrics, "current", None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.add(name, time.perf_counter() - start)
+
+
+def note_audio(audio):
+    """Record the seconds of decoded audio in the metrics of the current request, the first decode of a request counts."""
+    metrics = getattr(request_metrics, "current", None)
+    if metrics is not None and metrics.audio_seconds is None:
+        metrics.audio_seconds = round(len(audio) / SAMPLE_RATE, 3)
+
+
+class ModelCache:
+    """
+    In-process cache of loaded whisper models, keyed by model name and device.
+
+    Models are evicted least recently used first when the loaded models don't fit the memory budget.
+    Keeps hit/miss/eviction counters and the total time spent loading models.
+    """
+
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.models = collections.OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def get(self, model_name, model_dir_in, device=None):
+        device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        key = (model_name, device, precision)
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        self.misses += 1
+        self.evict(self.expected_size(model_name, model_dir_in))
+
+        start = time.perf_counter()
+        with stage("model_load"):
+            if precision == "int8" and device == "cpu":
+                model = load_quantized_model(model_name, model_dir_in)
+            else:
+                model = load_whisper_model(model_name, device, model_dir_in)
+        self.load_seconds += time.perf_counter() - start
+
+        self.models[key] = model
+        self.sizes[key] = model_bytes(model)
+        self.evict(0, keep=key)
+        return model
+
+    def expected_size(self, model_name, model_dir_in):
+        """Estimate the memory of a model before loading it, checkpoints are stored in fp16."""
+        checkpoint = checkpoint_path(model_name, model_dir_in)
+        if checkpoint and os.path.exists(checkpoint):
+            return 2 * os.path.getsize(checkpoint)
+        return 0
+
+    def evict(self, extra_bytes, keep=None):
+        """Evict least recently used models until the cached models plus extra_bytes fit the budget."""
+        if self.budget_bytes is None:
+            return
+        for key in list(self.models):
+            if sum(self.sizes.values()) + extra_bytes <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+            del self.models[key]
+            del self.sizes[key]
+            self.evictions += 1
+            if args.verbose:
+                print(f"Evicted model {key[0]} ({key[1]}, {key[2]}) from the model cache", file = sys.stderr)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        return {"models": [name for name, _, _ in self.models],
+                "bytes": sum(self.sizes.values()),
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_seconds": round(self.load_seconds, 3)}
+
+
+model_cache = ModelCache()
+
+
+def model_bytes(model):
+    """Memory of the weights of a model, quantized linear layers keep their int8 weights in packed params."""
+    tensors = []
+    for value in model.state_dict().values():
+        tensors.extend(value if isinstance(value, tuple) else [value])
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+def load_model(model_name, model_dir_in):
+    """Load a whisper model through the model cache, later calls reuse the loaded model."""
+    return model_cache.get(model_name, model_dir_in)
+
+
+def checkpoint_path(model_name, model_dir_in):
+    """Path of the downloaded checkpoint of a model, None for models whisper doesn't download."""
+    url = whisper._MODELS.get(model_name)
+    return os.path.join(model_dir_in, os.path.basename(url)) if url else None
+
+
+def checkpoint_verified(path, url):
+    """
+    Whether the checkpoint at path has the sha256 that is part of its download url.
+
+    The file is only hashed once, a <checkpoint>.verified stamp remembers its size and mtime,
+    so later loads only stat the checkpoint.
+    """
+    stat = os.stat(path)
+    stamp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": url.split("/")[-2]}
+    try:
+        with open(path + ".verified", "r") as stamp_file:
+            if json.load(stamp_file) == stamp:
+                return True
+    except (OSError, ValueError):
+        pass
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as checkpoint:
+        for chunk in iter(lambda: checkpoint.read(1024 * 1024), b""):
+            digest.update(chunk)
+    if digest.hexdigest() != stamp["sha256"]:
+        return False
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as tmp:
+            json.dump(stamp, tmp)
+        os.replace(tmp.name, path + ".verified")
+    except OSError:
+        pass
+    return True
+
+
+def load_whisper_model(model_name, device, model_dir_in):
+    """
+    whisper.load_model without hashing the whole checkpoint on every load.
+
+    A verified checkpoint (see checkpoint_verified) is memory mapped instead of read into memory first.
+    Missing or damaged checkpoints go through whisper.load_model, which downloads them.
+    """
+    url = whisper._MODELS.get(model_name)
+    path = checkpoint_path(model_name, model_dir_in)
+    if path is None or not os.path.exists(path) or not checkpoint_verified(path, url):
+        model = whisper.load_model(model_name, device=device, download_root=model_dir_in)
+        if path and os.path.exists(path):
+            checkpoint_verified(path, url)
+        return model
+
+    try:
+        checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # checkpoints in the legacy format can't be memory mapped
+        checkpoint = torch.load(path, map_location="cpu", weights_only=True)
+    model = whisper.model.Whisper(whisper.model.ModelDimensions(**checkpoint["dims"]))
+    model.load_state_dict(checkpoint["model_state_dict"])
+    alignment_heads = whisper._ALIGNMENT_HEADS.get(model_name)
+    if alignment_heads is not None:
+        model.set_alignment_heads(alignment_heads)
+    return model.to(device)
+
+
+def quantized_path(model_name, model_dir_in):
+    """Path of the int8 quantized model, stored next to the downloaded checkpoints."""
+    return os.path.join(model_dir_in, f"{model_name}.int8.pt")
+
+
+def load_quantized_model(model_name, model_dir_in):
+    """
+    Load a cpu model with int8 weights in its linear layers, using dynamic quantization.
+
+    The quantized model is saved in model_dir_in the first time, later loads skip the conversion.
+    """
+    path = quantized_path(model_name, model_dir_in)
+    if os.path.exists(path):
+        return torch.load(path, map_location="cpu", weights_only=False)
+
+    model = load_whisper_model(model_name, "cpu", model_dir_in)
+    # whisper's Linear only casts its weights to the input dtype, quantize_dynamic only converts nn.Linear itself
+    for module in model.modules():
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = torch.nn.Linear
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if args.verbose:
+        print(f"Quantized model {model_name} to int8, saving it to {path}", file = sys.stderr)
+    # write to a unique file first, concurrent loads never see a partly written model
+    with tempfile.NamedTemporaryFile(dir=model_dir_in, suffix=".tmp", delete=False) as tmp:
+        torch.save(model, tmp)
+    os.replace(tmp.name, path)
+    return model
+
+
+def bf16_supported():
+    """Whether the cpu has native bfloat16 instructions."""
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def inference_context(model):
+    """
+    Context running a model without autograd in the configured precision, bf16 autocasts cpu matrix
+    multiplications to bfloat16. Without it model.embed_audio would keep the activations of every encoder layer.
+    """
+    context = contextlib.ExitStack()
+    context.enter_context(torch.inference_mode())
+    if precision == "bf16" and model.device.type == "cpu":
+        context.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+    return context
+
+
+class ResultCache:
+    """
+    Persistent cache of words and transcription results, shared between processes through cache_dir.
+
+    Results are keyed by a hash of the audio content plus the model, language and decoding options,
+    so renamed, moved or duplicated recordings reuse earlier results.
+    The least recently used results are removed once the cache grows over max_bytes.
+    """
+    subdir = "results"
+    suffix = ".json"
+    mode = "w"
+
+    def __init__(self, cache_dir=None, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.cache_dir is not None
+
+    def key(self, audio_hash, kind, model_name, language, options):
+        """Cache key of a result, None when caching is disabled or the audio hash is unknown."""
+        if not self.enabled() or audio_hash is None:
+            return None
+        key_json = json.dumps([audio_hash, kind, model_name, language, options], sort_keys=True)
+        return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
 
+    def path(self, key):
+        return os.path.join(self.cache_dir, self.subdir, key[:2], f"{key}{self.suffix}")
 
-def get_first_words(audio_file_in, model_dir_in, max_words, trans_language = "en", model_name="base"):
-    model = whisper.load_model(model_name, download_root=model_dir_in)
+    def read(self, path):
+        with open(path, "r") as result_file:
+            return json.load(result_file)
 
-    # load audio and pad/trim it to fit 30 seconds
-    audio = whisper.load_audio(audio_file_in)
-    audio = whisper.pad_or_trim(audio)
+    def write(self, tmp_file, value):
+        json.dump(value, tmp_file)
 
-    # make log-Mel spectrogram and move to the same device as the model
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
+    def get(self, key):
+        if key is None:
+            return None
+        try:
+            value = self.read(self.path(key))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # mark as recently used for eviction, another process sharing cache_dir may have evicted it since the read
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        self.hits += 1
+        return value
 
-    if not model_name.endswith(".en"):
-        # detect the spoken language
-        _, probs = model.detect_language(mel)
-        lang_guess = max(probs, key=probs.get)
+    def put(self, key, value):
+        if key is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        with tempfile.NamedTemporaryFile(self.mode, dir=os.path.dirname(path), suffix=".tmp", delete=False) as tmp_file:
+            self.write(tmp_file, value)
+        os.replace(tmp_file.name, path)
+        if self.total_bytes is not None:
+            self.total_bytes += os.path.getsize(path) - old_size
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache fits max_bytes.
+        Files being written by other processes (.tmp) are left alone, files they removed meanwhile are skipped.
+        """
+        if self.total_bytes is not None and self.total_bytes <= self.max_bytes:
+            return
+        entries = []
+        for root, _, files in os.walk(os.path.join(self.cache_dir, self.subdir)):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+
+result_cache = ResultCache()
+
+
+class AudioCache(ResultCache):
+    """
+    Persistent cache of decoded audio, 16kHz float32 samples keyed by the hash of the encoded audio.
+
+    Samples are stored as .npy files and memory mapped when read, so renaming and transcribing with every model
+    reuse a single ffmpeg decode without copying the samples. The log-Mel spectrograms of words windows are
+    cached next to them. Least recently used arrays are removed once the cache grows over max_bytes.
+    """
+    subdir = "audio"
+    suffix = ".npy"
+    mode = "wb"
+
+    def key(self, audio_hash, variant=None):
+        """Cache key of the samples of audio, or of a variant like a spectrogram, None when caching is disabled."""
+        if not self.enabled() or audio_hash is None:
+            return None
+        return f"{audio_hash}-{variant}" if variant else audio_hash
+
+    def read(self, path):
+        # copy on write, the pages are shared with the page cache and writes never reach the file
+        return np.load(path, mmap_mode="c")
+
+    def write(self, tmp_file, value):
+        np.save(tmp_file, np.ascontiguousarray(value, dtype=np.float32))
+
+
+audio_cache = AudioCache()
+
+
+def cache_enabled():
+    """Whether audio is hashed for the result or audio cache."""
+    return result_cache.enabled() or audio_cache.enabled()
+
+
+def hash_audio(source):
+    """Content hash of encoded audio, given as bytes or a file path."""
+    digest = hashlib.sha256()
+    if isinstance(source, bytes):
+        digest.update(source)
+    else:
+        with open(source, "rb") as audio_file:
+            for chunk in iter(lambda: audio_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_samples(audio_in, max_seconds=None, audio_hash=None):
+    """
+    Audio samples of a file path, a function that decodes the audio, or already decoded samples.
+
+    With max_seconds only the start of the audio is returned, files are only decoded that far unless the
+    samples go to the audio cache. Samples of audio_hash are read from and stored in the audio cache.
+    """
+    with stage("load_audio"):
+        key = audio_cache.key(audio_hash)
+        audio = audio_cache.get(key)
+        if audio is None:
+            if isinstance(audio_in, str):
+                audio = decode_audio(audio_in, os.path.splitext(audio_in)[1][1:], None if key else max_seconds)
+            else:
+                audio = audio_in() if callable(audio_in) else audio_in
+            audio_cache.put(key, audio)
+        audio = audio[:int(max_seconds * SAMPLE_RATE)] if max_seconds else audio
+    note_audio(audio)
+    return audio
+
+
+def decode_audio(source, audio_ext, max_seconds=None, sr=SAMPLE_RATE):
+    """
+    Decode audio from a file path, a binary stream or bytes with ffmpeg, as 16kHz mono float32 samples.
+
+    Streams are piped straight into ffmpeg without a copy on disk.
+    Containers that need seeking (m4a/mp4) are spooled to a uniquely named file in tmp_dir first,
+    so several requests can be decoded at the same time.
+    With max_seconds only the start of a file or bytes is decoded, streams are always read to the end.
+    """
+    if not isinstance(source, str) and audio_ext in seekable_exts:
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix=f".{audio_ext}") as spool:
+            if isinstance(source, bytes):
+                spool.write(source)
+            else:
+                shutil.copyfileobj(source, spool, 1024 * 1024)
+            spool.flush()
+            return decode_audio(spool.name, audio_ext, max_seconds, sr)
+
+    limit = ["-t", str(max_seconds)] if max_seconds and not hasattr(source, "read") else []
+    cmd = ["ffmpeg", "-threads", "0", "-i", source if isinstance(source, str) else "pipe:0", *limit,
+           "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-"]
+    try:
+        if isinstance(source, str):
+            out = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, check=True).stdout
+        elif isinstance(source, bytes):
+            out = subprocess.run(cmd, input=source, capture_output=True, check=True).stdout
+        else:
+            out = subprocess.run(cmd, stdin=source, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def get_first_words(audio_in, model_dir_in, max_words, trans_language = "en", model_name="base", audio_hash=None):
+    result = get_first_words_batch([audio_in], model_dir_in, max_words, trans_language, model_name, [audio_hash])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result[0]
+
+
+def cached_first_window(key, audio_hash, model_name, trans_language, max_words):
+    """
+    Text of the first window from an earlier words or transcription result of the same audio, or None.
+
+    A words result that stopped decoding early is only used when it has more than max_words words.
+    Transcriptions are cached under the resolved language, see get_transcription.
+    """
+    cached = result_cache.get(key)
+    if cached is not None and (cached["complete"] or len(first_words(cached["text"], max_words + 1)) > max_words):
+        return cached["text"]
+    trans = result_cache.get(result_cache.key(audio_hash, "transcription", model_name,
+                                              resolve_language(trans_language, audio_hash), transcription_options()))
+    return first_window_text(trans, words_window) if trans is not None else None
+
+
+def decode_words(model, audio_features, trans_language, max_words):
+    """
+    Decode a batch of encoded windows until they have more than max_words words, instead of the whole window.
+
+    Decoding stops after a token budget, windows that ran out of budget with too few words are decoded again
+    with twice the budget. Returns a (text, complete) tuple per window, complete is False when decoding stopped early.
+    """
+    results = [None] * len(audio_features)
+    pending = list(range(len(audio_features)))
+    # about three tokens per word including punctuation
+    sample_len = 3 * max_words + 4
+    while pending:
+        full_window = sample_len >= model.dims.n_text_ctx // 2
+        options = whisper.DecodingOptions(fp16 = False, language=trans_language,
+                                          sample_len=None if full_window else sample_len)
+        still_pending = []
+        for i, result in zip(pending, whisper.decode(model, audio_features[pending], options)):
+            complete = full_window or len(result.tokens) < sample_len
+            if complete or len(first_words(result.text, max_words + 1)) > max_words:
+                results[i] = (result.text, complete)
+            else:
+                still_pending.append(i)
+        pending = still_pending
+        sample_len *= 2
+    return results
+
+
+def language_key(audio_hash):
+    """Result cache key of the detected language of audio, shared by all models."""
+    return result_cache.key(audio_hash, "language", None, None, {})
+
+
+def resolve_language(trans_language, audio_hash):
+    """Language to transcribe in, with "auto" the cached detected language of the audio or None to detect it."""
+    if trans_language != "auto":
+        return trans_language
+    detected = result_cache.get(language_key(audio_hash))
+    return detected["language"] if detected else None
+
+
+def detect_languages(model, model_name, audio_features, trans_language):
+    """
+    Detect the spoken language of a batch of encoded audio and warn when it isn't the input language.
+
+    Returns a dict with the language and the probabilities of the five likeliest languages for every audio,
+    .en models only know english.
+    """
+    if model_name.endswith(".en"):
         if args.verbose:
-            if lang_guess != trans_language:
+            print(f"Model with '.en', no detecting language.", file = sys.stderr)
+            if trans_language not in ["en", "auto"]:
+                print(f"WARNING!: using .en model with non en input language:", file = sys.stderr)
+        return [{"language": "en", "probs": {"en": 1.0}} for _ in range(len(audio_features))]
+
+    # detect the spoken language
+    _, probs = model.detect_language(audio_features)
+    detected = []
+    for lang_probs in probs:
+        lang_guess = max(lang_probs, key=lang_probs.get)
+        if args.verbose:
+            if trans_language not in [lang_guess, "auto"]:
                 print(f"Detected language: {lang_guess}\nWARNING!: It differs from the input language: {trans_language}", file = sys.stderr)
             else:
                 print(f"Detected language: {lang_guess}", file = sys.stderr)
+        likeliest = sorted(lang_probs.items(), key=lambda item: item[1], reverse=True)[:5]
+        detected.append({"language": lang_guess, "probs": {lang: round(prob, 4) for lang, prob in likeliest}})
+    return detected
+
+
+def get_first_words_batch(audio_list, model_dir_in, max_words, trans_language = "en", model_name="base",
+                          audio_hashes=None, max_bytes=None):
+    """
+    Get the first words of many recordings, their first words_window seconds are decoded together.
+
+    Decoding stops once there are enough words, see decode_words. Batches are split so the mel spectrograms
+    and encoder output of a batch fit in max_bytes. The detected language of every recording is cached,
+    with trans_language "auto" each recording is decoded in its detected language.
+    Returns a (words, detected language) tuple for every recording in order, or the exception raised while
+    loading its audio. The detected language is None when the words came from the cache without one.
+    """
+    audio_hashes = audio_hashes or [None] * len(audio_list)
+    keys = [result_cache.key(audio_hash, "first_window", model_name, trans_language,
+                             {"fp16": False, "precision": precision, "window": words_window})
+            for audio_hash in audio_hashes]
+    texts = [cached_first_window(key, audio_hash, model_name, trans_language, max_words)
+             for key, audio_hash in zip(keys, audio_hashes)]
+    languages = [result_cache.get(language_key(audio_hash)) for audio_hash in audio_hashes]
+
+    pending = [i for i, text in enumerate(texts) if text is None]
+    if pending:
+        model = load_model(model_name, model_dir_in)
+
+        # load the words window of the audio, pad it to fit 30 seconds and make its log-Mel spectrogram
+        mels = {}
+        for i in pending:
+            try:
+                mel_key = audio_cache.key(audio_hashes[i], f"mel{model.dims.n_mels}-{words_window:g}")
+                mel = audio_cache.get(mel_key)
+                if mel is None:
+                    audio = whisper.pad_or_trim(load_samples(audio_list[i], words_window, audio_hashes[i]))
+                    with stage("mel"):
+                        mel = whisper.log_mel_spectrogram(audio, model.dims.n_mels).numpy()
+                    audio_cache.put(mel_key, mel)
+                mels[i] = torch.from_numpy(mel)
+            except Exception as e:
+                texts[i] = e
+
+        item_bytes = 4 * (model.dims.n_mels * whisper.audio.N_FRAMES + model.dims.n_audio_ctx * model.dims.n_audio_state)
+        batch_size = len(mels) if max_bytes is None else max(1, max_bytes // item_bytes)
+        indices = list(mels)
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            mel = torch.stack([mels[i] for i in batch]).to(model.device)
+
+            # a single encoder pass, shared by language detection and decoding
+            with inference_context(model):
+                with stage("encode"):
+                    audio_features = model.embed_audio(mel)
+                with stage("language"):
+                    detected = detect_languages(model, model_name, audio_features, trans_language)
+            for i, language in zip(batch, detected):
+                languages[i] = language
+                if not model_name.endswith(".en"):
+                    result_cache.put(language_key(audio_hashes[i]), language)
+
+            # decode the audio, with auto in the detected language
+            decode_langs = [language["language"] if trans_language == "auto" else trans_language for language in detected]
+            for decode_lang in set(decode_langs):
+                group = [j for j, lang in enumerate(decode_langs) if lang == decode_lang]
+                with inference_context(model), stage("decode"):
+                    decoded = decode_words(model, audio_features[group], decode_lang, max_words)
+                for j, (text, complete) in zip(group, decoded):
+                    texts[batch[j]] = text
+                    result_cache.put(keys[batch[j]], {"text": text, "complete": complete})
+
+    return [text if isinstance(text, Exception) else (first_words(text, max_words), language)
+            for text, language in zip(texts, languages)]
+
+
+def first_words(text, max_words):
+    """Limit text to its first max_words words."""
+    words = re.findall(r'\b[\w\',]+\b', text)
+    last_word_index = min(max_words, len(words))
+    return words[:last_word_index]
+
+
+def first_window_text(trans, window=CHUNK_LENGTH):
+    """Text of the transcription segments that start in the first window seconds."""
+    return " ".join(seg["text"] for seg in trans["segments"] if seg["start"] < window)
+
+
+def speech_regions(audio, threshold_db=-45.0, min_silence=1.0, pad=0.3, frame_seconds=0.03,
+                   sr=SAMPLE_RATE):
+    """
+    Find the speech regions of audio with an energy based voice activity detection.
+
+    Frames louder than threshold_db (dBFS) are speech, silences shorter than min_silence seconds are bridged
+    and every region is padded by pad seconds. Returns a list of (start, end) sample indices.
+    """
+    frame = int(frame_seconds * sr)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [(0, len(audio))] if len(audio) else []
+
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    frame_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    speech_frames = np.flatnonzero(frame_db > threshold_db)
+    if len(speech_frames) == 0:
+        return []
+
+    # split the speech frames where the silence between them is long enough
+    max_gap = int(min_silence / frame_seconds)
+    breaks = np.flatnonzero(np.diff(speech_frames) > max_gap)
+    starts = np.concatenate([[speech_frames[0]], speech_frames[breaks + 1]])
+    ends = np.concatenate([speech_frames[breaks], [speech_frames[-1]]]) + 1
+
+    pad_samples = int(pad * sr)
+    regions = []
+    for start, end in zip(starts * frame - pad_samples, ends * frame + pad_samples):
+        start, end = max(0, int(start)), min(len(audio), int(end))
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def remap_timestamps(result, regions, sr=SAMPLE_RATE):
+    """Map the timestamps of a transcription of concatenated speech regions back to the original audio."""
+    region_starts = [start / sr for start, _ in regions]
+    compact_starts = list(np.cumsum([0] + [end - start for start, end in regions[:-1]]) / sr)
+
+    def remap(t, is_end):
+        # an end that falls on a region boundary belongs to the region before it
+        find = bisect.bisect_left if is_end else bisect.bisect_right
+        i = max(find(compact_starts, t) - 1, 0)
+        return round(float(region_starts[i] + t - compact_starts[i]), 3)
+
+    for seg in result["segments"]:
+        seg["start"], seg["end"] = remap(seg["start"], False), remap(seg["end"], True)
+        for word in seg.get("words", []):
+            word["start"], word["end"] = remap(word["start"], False), remap(word["end"], True)
+
+
+def chunk_bounds(audio, chunk_seconds, overlap, frame_seconds=0.1, sr=SAMPLE_RATE):
+    """
+    Split audio into chunks of at most chunk_seconds, cut at the quietest frame of the last quarter of each chunk.
+
+    Returns a list of (start, end, own_start, own_end) sample indices. Chunks overlap by overlap seconds
+    around each cut, a chunk owns the part of the timeline between its cuts.
+    """
+    chunk = int(chunk_seconds * sr)
+    if len(audio) <= chunk:
+        return [(0, len(audio), 0, len(audio))]
+
+    frame = int(frame_seconds * sr)
+    n_frames = len(audio) // frame
+    frame_energy = np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1)
+
+    cuts = [0]
+    while len(audio) - cuts[-1] > chunk:
+        first_frame = (cuts[-1] + chunk * 3 // 4) // frame
+        last_frame = min((cuts[-1] + chunk) // frame, n_frames)
+        quietest = first_frame + int(np.argmin(frame_energy[first_frame:last_frame]))
+        cuts.append(quietest * frame + frame // 2)
+    cuts.append(len(audio))
+
+    overlap_samples = int(overlap * sr)
+    return [(max(0, own_start - overlap_samples), min(len(audio), own_end + overlap_samples), own_start, own_end)
+            for own_start, own_end in zip(cuts, cuts[1:])]
+
+
+def shift_segments(segments, offset):
+    """Move the timestamps of segments and their words by offset seconds."""
+    for seg in segments:
+        seg["start"], seg["end"] = round(seg["start"] + offset, 3), round(seg["end"] + offset, 3)
+        for word in seg.get("words", []):
+            word["start"], word["end"] = round(word["start"] + offset, 3), round(word["end"] + offset, 3)
+    return segments
+
+
+def stitch_chunks(chunk_results, bounds, sr=SAMPLE_RATE):
+    """
+    Join the transcriptions of overlapping chunks into one transcription on the original timeline.
+
+    A segment is kept by the chunk that owns its midpoint, which drops the text repeated in the overlaps.
+    """
+    segments = []
+    for result, (start, _, own_start, own_end) in zip(chunk_results, bounds):
+        for seg in shift_segments(result["segments"], start / sr):
+            if own_start <= (seg["start"] + seg["end"]) / 2 * sr < own_end:
+                seg["id"] = len(segments)
+                segments.append(seg)
+
+    return {"text": "".join(seg["text"] for seg in segments),
+            "segments": segments,
+            "language": chunk_results[0]["language"]}
+
+
+def init_chunk_worker(threads, verbose, precision_in):
+    """Initializer of the chunk worker processes."""
+    global args, precision
+    args = argparse.Namespace(verbose=verbose)
+    precision = precision_in
+    torch.set_num_threads(threads)
+
+
+def transcribe_chunk(model_name, model_dir_in, chunk, trans_language):
+    """Transcribe one chunk in a worker process, every worker loads the model once."""
+    model = load_model(model_name, model_dir_in)
+    with inference_context(model):
+        return model.transcribe(chunk, fp16 = False, language=trans_language)
+
+
+def transcribe_chunked(audio, model_dir_in, trans_language, model_name):
+    """Transcribe a long recording in overlapping chunks on a pool of chunk_options["workers"] processes."""
+    bounds = chunk_bounds(audio, chunk_options["chunk_seconds"], chunk_options["overlap"])
+    workers = min(chunk_options["workers"], len(bounds))
+    # split the cpu threads between the workers
+    threads = max(1, torch.get_num_threads() // workers)
+    if args.verbose:
+        print(f"Transcribing {len(bounds)} chunks on {workers} workers with {threads} threads each", file = sys.stderr)
+
+    with stage("transcribe"), concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_chunk_worker,
+            initargs=(threads, args.verbose, precision)) as pool:
+        chunk_results = list(pool.map(transcribe_chunk, itertools.repeat(model_name), itertools.repeat(model_dir_in),
+                                      [audio[start:end] for start, end, _, _ in bounds],
+                                      itertools.repeat(trans_language)))
+
+    return stitch_chunks(chunk_results, bounds)
+
+
+def transcribe_samples(audio, model_dir_in, trans_language, model_name):
+    """
+    Transcribe decoded samples, in chunks on a process pool when chunking is enabled and the audio is long.
+
+    With a cascade the weak segments are transcribed again with the cascade model, see escalate_segments.
+    """
+    if chunk_options and len(audio) > chunk_options["chunk_seconds"] * SAMPLE_RATE:
+        result = transcribe_chunked(audio, model_dir_in, trans_language, model_name)
+    else:
+        model = load_model(model_name, model_dir_in)
+        with inference_context(model), stage("transcribe"):
+            result = model.transcribe(audio, fp16 = False, language=trans_language)
+
+    if cascade_options and cascade_options["model"] != model_name:
+        escalate_segments(result, audio, model_dir_in, trans_language)
+    return result
 
-    elif args.verbose:
-        print(f"Model with '.en', no detecting language.", file = sys.stderr)
-        if trans_language != 'en':
-            print(f"WARNING!: using .en model with non en input language:", file = sys.stderr)
 
-    #TODO decode in dedected language?
+def weak_segment(seg):
+    """
+    Whether a segment is likely wrong: a low average log probability or a high compression ratio (repetitions),
+    the thresholds whisper itself retries decoding with. Segments whisper takes for silence aren't weak.
+    """
+    if seg["no_speech_prob"] > cascade_options["no_speech"] and seg["avg_logprob"] < cascade_options["logprob"]:
+        return False
+    return seg["avg_logprob"] < cascade_options["logprob"] or seg["compression_ratio"] > cascade_options["compression"]
 
-    # decode the audio
-    options = whisper.DecodingOptions(fp16 = False, language=trans_language)
-    result = whisper.decode(model, mel, options)
 
-    # limit to first words_in_name words
-    first_words = re.findall(r'\b[\w\',]+\b', result.text)
-    last_word_index = min(max_words, len(first_words))
-    return first_words[:last_word_index]
+def weak_spans(weak, audio_seconds, pad=0.5):
+    """
+    Merge weak segments into spans to transcribe again: [start, end, weak_start, weak_end] in seconds, where
+    start and end are padded by pad seconds for context and weak_start and weak_end are the unpadded weak range.
+    """
+    spans = []
+    for seg in weak:
+        start, end = max(0.0, seg["start"] - pad), min(audio_seconds, seg["end"] + pad)
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+            spans[-1][3] = max(spans[-1][3], seg["end"])
+        else:
+            spans.append([start, end, seg["start"], seg["end"]])
+    return spans
+
+
+def trim_segment(seg, weak_start, weak_end):
+    """
+    Cut a segment transcribed with word timestamps down to its words centered in the weak range.
+    Returns None when none of its words are, the words themselves are dropped like in any other segment.
+    """
+    centered = lambda word: weak_start <= (word["start"] + word["end"]) / 2 < weak_end
+    words = [word for word in seg["words"] if centered(word)]
+    if not words:
+        return None
+    trimmed = {key: value for key, value in seg.items() if key != "words"}
+    trimmed.update(start=words[0]["start"], end=words[-1]["end"], text="".join(word["word"] for word in words))
+    return trimmed
+
+
+def splice_segments(segments, replacement, weak_start, weak_end):
+    """
+    Replace the segments centered in the weak range with the replacement words centered in it, the padding
+    of a span overlaps the segments around it, which are kept. Replacement segments without words are
+    kept whole when they are centered in the weak range.
+    """
+    centered = lambda seg: weak_start <= (seg["start"] + seg["end"]) / 2 < weak_end
+    spliced = []
+    for seg in replacement:
+        if seg.get("words"):
+            seg = trim_segment(seg, weak_start, weak_end)
+            if seg is not None:
+                spliced.append(seg)
+        elif centered(seg):
+            spliced.append(seg)
+    return [seg for seg in segments if not centered(seg)] + spliced
 
 
-def get_transcription(audio_file_in, model_dir_in, trans_language = "en", model_name = "base.en"):
-    result = ''
+def escalate_segments(result, audio, model_dir_in, trans_language, pad=0.5, sr=SAMPLE_RATE):
+    """
+    Transcribe the weak segments of result again with the cascade model and put its segments in their place.
+
+    Neighbouring weak segments are transcribed as one span padded by pad seconds with word timestamps,
+    see weak_spans and splice_segments.
+    Adds a cascade report to result with the seconds of the weak segments and their share of the audio.
+    """
+    audio_seconds = len(audio) / sr
+    weak = [seg for seg in result["segments"] if weak_segment(seg)]
+    spans = weak_spans(weak, audio_seconds, pad)
+
+    if spans:
+        model = load_model(cascade_options["model"], model_dir_in)
+        segments = result["segments"]
+        for start, end, weak_start, weak_end in spans:
+            with inference_context(model), stage("escalate"):
+                # word timestamps let the words of the padding be dropped, even when a single segment covers the span
+                span_res = model.transcribe(audio[int(start * sr):int(end * sr)], fp16 = False, word_timestamps=True,
+                                            language=trans_language or result["language"])
+            segments = splice_segments(segments, shift_segments(span_res["segments"], start), weak_start, weak_end)
+        segments.sort(key=lambda seg: seg["start"])
+        for i, seg in enumerate(segments):
+            seg["id"] = i
+        result["segments"] = segments
+        result["text"] = "".join(seg["text"] for seg in segments)
+
+    escalated = sum(seg["end"] - seg["start"] for seg in weak)
+    result["cascade"] = {"model": cascade_options["model"],
+                         "weak_segments": len(weak),
+                         "spans": len(spans),
+                         "escalated_seconds": round(escalated, 3),
+                         "audio_seconds": round(audio_seconds, 3),
+                         "escalated_share": round(escalated / audio_seconds, 4) if audio_seconds else 0.0}
+    if args.verbose:
+        print(f"Cascade: {len(weak)} weak segments, {result['cascade']['escalated_seconds']}s of "
+              f"{result['cascade']['audio_seconds']}s transcribed again with {cascade_options['model']}", file = sys.stderr)
+
+
+def transcription_options():
+    """Options that change a transcription result, part of its result cache key."""
+    chunking = {key: chunk_options[key] for key in ["chunk_seconds", "overlap"]} if chunk_options else None
+    return {"fp16": False, "precision": precision, "vad": vad_options, "chunk": chunking, "cascade": cascade_options}
+
+
+def get_transcription(audio_in, model_dir_in, trans_language = "en", model_name = "base.en", audio_hash=None):
+    # with auto use the language detected earlier for this audio, None lets whisper detect it
+    trans_language = resolve_language(trans_language, audio_hash)
+    key = result_cache.key(audio_hash, "transcription", model_name, trans_language, transcription_options())
+    result = result_cache.get(key)
+    if result is not None:
+        return result
 
-    model = whisper.load_model(model_name, download_root=model_dir_in)
     # audio = whisper.load_audio(audio_file_in)
     # audio = whisper.pad_or_trim(audio)
     # # make log-Mel spectrogram and move to the same device as the model
@@ -59,65 +995,602 @@ def get_transcription(audio_file_in, model_dir_in, trans_language = "en", model_
     # options = whisper.DecodingOptions(fp16 = False, language="en")
     # result = whisper.decode(model, mel, options)
 
-    transcription_res = model.transcribe(audio_file_in, fp16 = False, language=trans_language)
+    audio = load_samples(audio_in, audio_hash=audio_hash)
+    if vad_options is None:
+        transcription_res = transcribe_samples(audio, model_dir_in, trans_language, model_name)
+    else:
+        # only transcribe the speech regions, the timestamps are mapped back to the original audio
+        with stage("vad"):
+            regions = speech_regions(audio, **vad_options)
+        speech_samples = sum(end - start for start, end in regions)
+        if regions:
+            speech = np.concatenate([audio[start:end] for start, end in regions])
+            transcription_res = transcribe_samples(speech, model_dir_in, trans_language, model_name)
+            remap_timestamps(transcription_res, regions)
+        else:
+            transcription_res = {"text": "", "segments": [], "language": trans_language}
+        transcription_res["vad"] = {"audio_seconds": round(len(audio) / SAMPLE_RATE, 3),
+                                    "speech_seconds": round(speech_samples / SAMPLE_RATE, 3)}
+        if args.verbose:
+            print(f"Voice activity: {transcription_res['vad']['speech_seconds']}s of speech in "
+                  f"{transcription_res['vad']['audio_seconds']}s of audio", file = sys.stderr)
     result = transcription_res
+    if trans_language is None and result["language"]:
+        result_cache.put(language_key(audio_hash), {"language": result["language"], "probs": None})
+        key = result_cache.key(audio_hash, "transcription", model_name, result["language"], transcription_options())
+    result_cache.put(key, result)
 
     return result
 
 
+def stream_transcription(audio_in, model_dir_in, trans_language, model_name, audio_hash=None,
+                         chunk_seconds=60.0, out=sys.stdout):
+    """
+    Transcribe audio and write each segment as a json line as soon as it is decoded.
+
+    The audio is transcribed in chunks cut at silences, the text of each chunk is the prompt of the next one.
+    With a cascade the weak segments of a chunk are escalated before its segments are written.
+    Segment lines are followed by a progress line after every chunk and a final done line with the full text.
+    Chunks depend on each other, so they aren't transcribed on a process pool.
+    """
+    def emit(line):
+        out.write(json.dumps(line) + "\n")
+        out.flush()
+
+    trans_language = resolve_language(trans_language, audio_hash)
+    stream_key = result_cache.key(audio_hash, "transcription", model_name, trans_language,
+                                  {**transcription_options(), "stream_chunk": chunk_seconds})
+    result = (result_cache.get(result_cache.key(audio_hash, "transcription", model_name, trans_language,
+                                                transcription_options()))
+              or result_cache.get(stream_key))
+    if result is not None:
+        for seg in result["segments"]:
+            emit({"type": "segment", **seg})
+        emit({"type": "done", "text": result["text"], "language": result["language"]})
+        return result
+
+    audio = load_samples(audio_in, audio_hash=audio_hash)
+    with stage("vad"):
+        regions = speech_regions(audio, **vad_options) if vad_options else [(0, len(audio))]
+    speech = np.concatenate([audio[start:end] for start, end in regions]) if regions else audio[:0]
+    bounds = chunk_bounds(speech, chunk_seconds, 0) if len(speech) else []
+
+    model = load_model(model_name, model_dir_in)
+    segments = []
+    escalated = 0.0
+    language = trans_language
+    prompt = None
+    for start, end, _, _ in bounds:
+        with inference_context(model), stage("transcribe"):
+            chunk_res = model.transcribe(speech[start:end], fp16 = False, language=language, initial_prompt=prompt)
+        if cascade_options and cascade_options["model"] != model_name:
+            escalate_segments(chunk_res, speech[start:end], model_dir_in, language)
+            escalated += chunk_res["cascade"]["escalated_seconds"]
+        language = chunk_res["language"]
+        prompt = chunk_res["text"]
+
+        chunk_segments = shift_segments(chunk_res["segments"], start / SAMPLE_RATE)
+        if vad_options:
+            remap_timestamps({"segments": chunk_segments}, regions)
+        for seg in chunk_segments:
+            seg["id"] = len(segments)
+            segments.append(seg)
+            emit({"type": "segment", **seg})
+        emit({"type": "progress",
+              "seconds": round(end / SAMPLE_RATE, 3),
+              "total_seconds": round(len(speech) / SAMPLE_RATE, 3)})
+
+    result = {"text": "".join(seg["text"] for seg in segments), "segments": segments, "language": language}
+    if cascade_options and cascade_options["model"] != model_name:
+        audio_seconds = len(speech) / SAMPLE_RATE
+        result["cascade"] = {"model": cascade_options["model"],
+                             "escalated_seconds": round(escalated, 3),
+                             "audio_seconds": round(audio_seconds, 3),
+                             "escalated_share": round(escalated / audio_seconds, 4) if audio_seconds else 0.0}
+    result_cache.put(stream_key, result)
+    emit({"type": "done", "text": result["text"], "language": language})
+    return result
+
+
+def get_words_and_transcription(audio_in, model_dir_in, max_words, trans_language = "en", model_name = "base.en",
+                                audio_hash=None):
+    """
+    Get the first words and the full transcription from a single decode and transcription pass.
+
+    The words come from the segments in the first words_window seconds, the window get_first_words decodes.
+    """
+    trans = get_transcription(audio_in, model_dir_in, trans_language, model_name, audio_hash)
+    return first_words(first_window_text(trans, words_window), max_words), trans
+
+
+def run_request(audio_in, output, model_dir_in, max_words, trans_language, model_name, audio_hash=None):
+    """
+    Run a single words/text/json request and return its result.
+
+    The audio is a file path, decoded samples or a function decoding the audio, which is only called when
+    the result isn't cached for audio_hash.
+    """
+    if output == "words":
+        return get_first_words(audio_in, model_dir_in, max_words, trans_language, model_name, audio_hash)
+    elif output in ["words+text", "words+json"]:
+        words, trans = get_words_and_transcription(audio_in, model_dir_in, max_words, trans_language, model_name,
+                                                   audio_hash)
+        return {"words": words, "transcription": trans["text"] if output == "words+text" else trans}
+
+    trans = get_transcription(audio_in, model_dir_in, trans_language, model_name, audio_hash)
+    if output == "text":
+        return trans["text"]
+    elif output == "json":
+        return trans
+    else:
+        raise ValueError(f"bad output mode: {output}")
+
+
+def format_output(output, result):
+    """Format a request result the way it is printed to stdout."""
+    if output == "words":
+        return " ".join(result) + "\n"
+    elif output == "text":
+        return result + "\n"
+    else:
+        return json.dumps(result, indent=2)
+
+
+def parse_batch_line(line, defaults):
+    """
+    Parse one manifest line into a request dict.
+
+    A line is either a bare audio file path or a json object with a "file" key and
+    optional "id", "output", "model", "lang" and "get_words" keys.
+    Missing keys are taken from the command line arguments.
+    """
+    line = line.strip()
+    request = json.loads(line) if line.startswith("{") else {"file": line}
+
+    if "file" not in request:
+        raise ValueError("manifest entry has no file")
+    request = {**defaults, **request}
+    if request["model"] not in model_choices:
+        raise ValueError(f"unknown model: {request['model']}")
+    if request["output"] not in output_choices:
+        raise ValueError(f"bad output mode: {request['output']}")
+    return request
+
+
+def read_manifest(manifest, lines):
+    """Reader thread of a batch run, puts the manifest lines on a queue and None when the manifest ends."""
+    for line in manifest:
+        lines.put(line)
+    lines.put(None)
+
+
+def parse_batch_entry(line_num, line, defaults):
+    """Parse a manifest line, returns its response and request, the request is None when the line is bad."""
+    response = {"id": line_num}
+    try:
+        request = parse_batch_line(line, defaults)
+        response = {"id": request.get("id", line_num), "file": request["file"]}
+        request["audio_hash"] = hash_audio(request["file"]) if cache_enabled() else None
+        return response, request
+    except Exception as e:
+        fail_batch_entry(response, e)
+        return response, None
+
+
+def fail_batch_entry(response, error):
+    response["ok"] = False
+    response["error"] = f"{type(error).__name__}: {error}"
+    if args.verbose:
+        print(f"Failed manifest entry {response['id']}: {response['error']}", file = sys.stderr)
+
+
+def run_batch_group(entries, model_dir_in, max_bytes):
+    """Run the requests of a group of manifest entries, words requests sharing model and language are batched."""
+    words_groups = {}
+    for response, request in entries:
+        if request is None:
+            continue
+        if request["output"] == "words":
+            group_key = (request["model"], request["lang"], request["get_words"])
+            words_groups.setdefault(group_key, []).append((response, request))
+            continue
+        metrics = start_metrics()
+        try:
+            response["result"] = run_request(request["file"], request["output"], model_dir_in, request["get_words"],
+                                             request["lang"], request["model"], request["audio_hash"])
+            response["ok"] = True
+        except Exception as e:
+            fail_batch_entry(response, e)
+        if metrics:
+            response["metrics"] = metrics.as_dict()
+
+    for (model_name, lang, max_words), group in words_groups.items():
+        # the requests of a words batch share its metrics, with the number of requests in the batch
+        metrics = start_metrics()
+        try:
+            results = get_first_words_batch([request["file"] for _, request in group], model_dir_in, max_words, lang,
+                                            model_name, [request["audio_hash"] for _, request in group], max_bytes)
+        except Exception as e:
+            results = [e] * len(group)
+        batch_metrics = {**metrics.as_dict(), "audio_seconds": None, "rtf": None, "batch": len(group)} if metrics else None
+        for (response, _), result in zip(group, results):
+            if isinstance(result, Exception):
+                fail_batch_entry(response, result)
+            else:
+                response["result"], response["language"] = result
+                response["ok"] = True
+            if batch_metrics:
+                response["metrics"] = batch_metrics
+
+
+def run_batch(manifest, model_dir_in, defaults, batch_size=8, batch_max_bytes=None):
+    """
+    Run every request of a manifest, each requested model is loaded only once.
+
+    The lines already available are taken in groups of up to batch_size, words requests of a group
+    are decoded together in batches that fit batch_max_bytes.
+    Results are written to stdout as one json line per request, in manifest order, as soon as their group is done,
+    failures are reported in place and don't stop the batch.
+    """
+    lines = queue.Queue()
+    threading.Thread(target=read_manifest, args=(manifest, lines), daemon=True).start()
+
+    done = 0
+    line_num = 0
+    finished = False
+    while not finished:
+        group = [lines.get()]
+        while group[-1] is not None and len(group) < batch_size:
+            try:
+                group.append(lines.get_nowait())
+            except queue.Empty:
+                break
+        if group[-1] is None:
+            finished = True
+            group.pop()
+
+        entries = []
+        for line in group:
+            if line.strip():
+                entries.append(parse_batch_entry(line_num, line, defaults))
+            line_num += 1
+        run_batch_group(entries, model_dir_in, batch_max_bytes)
+
+        for response, _ in entries:
+            print(json.dumps(response), flush=True)
+            done += response["ok"]
+
+    return done
+
+
+def read_request(stream, defaults):
+    """
+    Read a daemon request header from a client connection stream.
+
+    A request is a json header line, transcription requests are followed by "size" bytes of audio
+    once the daemon answered the header with a continue line, see read_audio.
+    Options of the daemon process, such as precision or vad, are rejected instead of being ignored.
+    Returns the request dict.
+    """
+    header = stream.readline()
+    if not header:
+        raise ValueError("empty request")
+
+    header = json.loads(header)
+    process_options = set(header) - request_keys - ignored_request_keys
+    if process_options:
+        raise ValueError(f"{', '.join(sorted(process_options))} can't change per request, "
+                         "start the daemon with them instead")
+    request = {**defaults, **header}
+    if request.get("type", "transcribe") != "transcribe":
+        return request
+    if request["model"] not in model_choices:
+        raise ValueError(f"unknown model: {request['model']}")
+    if request["output"] not in output_choices:
+        raise ValueError(f"bad output mode: {request['output']}")
+    return request
+
+
+def read_audio(conn, stream, request):
+    """Tell the client to send the audio of a transcription request and read its "size" bytes."""
+    conn.sendall((json.dumps({"continue": True}) + "\n").encode("utf-8"))
+    size = int(request.get("size", 0))
+    audio = stream.read(size)
+    if len(audio) != size:
+        raise ValueError(f"expected {size} bytes of audio, got {len(audio)}")
+    return audio
+
+
+def send_response(conn, response):
+    """Send a json line response and close the client connection."""
+    try:
+        conn.sendall((json.dumps(response) + "\n").encode("utf-8"))
+    except OSError as e:
+        if args.verbose:
+            print(f"Failed sending response: {e}", file = sys.stderr)
+    finally:
+        conn.close()
+
+
+def serve_jobs(jobs, model_dir_in):
+    """Worker loop of the daemon, runs queued requests one at a time until it gets None."""
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        conn, request = job
+        if request.get("type") == "warm":
+            try:
+                load_model(request["model"], model_dir_in)
+                send_response(conn, {"ok": True, "model_cache": model_cache.stats()})
+            except Exception as e:
+                send_response(conn, {"ok": False, "error": f"{type(e).__name__}: {e}"})
+            continue
+
+        metrics = start_metrics(request["metrics"])
+        if metrics:
+            metrics.add("queue", time.perf_counter() - request["queued_at"])
+        try:
+            result = run_request(request["audio"], request["output"], model_dir_in,
+                                 int(request["get_words"]), request["lang"], request["model"], request["audio_hash"])
+            with stage("output"):
+                response = {"ok": True, "out": format_output(request["output"], result)}
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        if metrics:
+            response["metrics"] = metrics.as_dict()
+
+        send_response(conn, response)
+
+
+def accept_request(conn, jobs, defaults, in_flight):
+    """
+    Read a request, decode its audio and put it on the job queue.
+
+    Besides transcriptions the daemon answers ping and stats requests, warm requests load a model ahead of time.
+
+    Without the caches decoding happens on the connection thread, so ffmpeg runs concurrently with the model.
+    With them the decode is queued with the request, so results that are already cached don't decode at all.
+    When the queue is full the client is told the daemon is busy after the header, before it sends its audio,
+    so callers can back off and retry instead of piling up audio in memory. The in_flight semaphore is
+    released when the request is queued or answered.
+    """
+    try:
+        conn.settimeout(60)
+        metrics = start_metrics()
+        stream = conn.makefile("rb")
+        with stage("read"):
+            request = read_request(stream, defaults)
+        if request.get("type") == "ping":
+            send_response(conn, {"ok": True, "queued": jobs.qsize()})
+            return
+        if request.get("type") == "stats":
+            send_response(conn, {"ok": True, "model_cache": model_cache.stats(), "result_cache": result_cache.stats(),
+                                 "audio_cache": audio_cache.stats()})
+            return
+        if request.get("type") == "warm":
+            # models are loaded by the worker thread, the only thread using the model cache
+            jobs.put_nowait((conn, request))
+            return
+        if jobs.full():
+            raise queue.Full
+        with stage("read"):
+            request["audio"] = read_audio(conn, stream, request)
+        request["audio_hash"] = hash_audio(request["audio"]) if cache_enabled() else None
+        data = request["audio"]
+        decode = lambda: decode_audio(data, request.get("audio_file_ext", "mp3"))
+        # with the caches the worker decodes only when the result isn't cached, see run_request
+        request["audio"] = decode if request["audio_hash"] else load_samples(decode)
+        request["metrics"] = metrics
+        request["queued_at"] = time.perf_counter()
+        conn.settimeout(None)
+        jobs.put_nowait((conn, request))
+    except queue.Full:
+        send_response(conn, {"ok": False, "busy": True, "error": "queue is full"})
+    except Exception as e:
+        send_response(conn, {"ok": False, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        in_flight.release()
+
+
+def serve(socket_path, model_dir_in, defaults, queue_size):
+    """
+    Serve requests on a unix socket, loaded models stay in memory between requests.
+
+    Requests are handled one at a time from a bounded queue. At most queue_size connections are read and decoded
+    at once, more are told the daemon is busy before they send their audio.
+    On SIGTERM or SIGINT the daemon stops accepting requests, finishes the queued ones and removes the socket.
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(queue_size)
+    server.settimeout(0.5)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    jobs = queue.Queue(maxsize=queue_size)
+    in_flight = threading.BoundedSemaphore(queue_size)
+    worker = threading.Thread(target=serve_jobs, args=(jobs, model_dir_in))
+    worker.start()
+
+    if args.verbose:
+        print(f"Listening on {socket_path}", file = sys.stderr)
+
+    while not stop.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        if not in_flight.acquire(blocking=False):
+            send_response(conn, {"ok": False, "busy": True, "error": "too many requests in flight"})
+            continue
+        threading.Thread(target=accept_request, args=(conn, jobs, defaults, in_flight), daemon=True).start()
+
+    server.close()
+    os.unlink(socket_path)
+    if args.verbose:
+        print(f"Shutting down, finishing {jobs.qsize()} queued requests", file = sys.stderr)
+    jobs.put(None)
+    worker.join()
+
+
 if __name__ == '__main__':
-    model_choices = ["tiny", "tiny.en", "base", "base.en", "small", "small.en", "medium.en", "turbo"]
 
     parser = argparse.ArgumentParser(description="Transcribe audio files using Whisper.")
     parser.add_argument("--audio-file-ext", dest="audio_ext", default="mp3", help="Path to the audio file")
     parser.add_argument("--get-words", dest="get_words", type=int, default=4, help="Number of first words to get; this defaults to first 30 seconds of recording")
-    parser.add_argument("--lang", type=str, default="en", help="Language of transcription")
-    parser.add_argument("--output", type=str, default="text", help="output type")
+    parser.add_argument("--words-window", dest="words_window", type=float, default=CHUNK_LENGTH,
+                        help="Seconds at the start of the recording decoded for --get-words, at most 30")
+    parser.add_argument("--lang", type=str, default="en",
+                        help="Language of transcription, auto decodes in the detected language of each recording")
+    parser.add_argument("--output", type=str, default="text", choices=output_choices + [stream_output],
+                        help="output type, words+text and words+json output the first words and the transcription as json, "
+                             "jsonl writes every segment as a json line while transcribing")
+    parser.add_argument("--stream-chunk-seconds", dest="stream_chunk_seconds", type=float, default=60.0,
+                        help="Longest chunk transcribed before its segments are written in jsonl output")
     parser.add_argument("--model", type=str, default="base", 
                         choices=model_choices, 
                         help="Whisper model (base, small, medium, large...)")
+    parser.add_argument("--precision", type=str, default="fp32", choices=precision_choices,
+                        help="Precision of cpu inference, int8 quantizes the linear layers once and caches them in the model "
+                             "directory, bf16 needs a cpu with bfloat16 instructions")
+    parser.add_argument("--cascade-model", dest="cascade_model", type=str, default=None, choices=model_choices,
+                        help="Transcribe with --model first and only transcribe its low confidence segments again with this larger model")
+    parser.add_argument("--cascade-logprob", dest="cascade_logprob", type=float, default=-1.0,
+                        help="Segments with a lower average log probability are transcribed again")
+    parser.add_argument("--cascade-compression", dest="cascade_compression", type=float, default=2.4,
+                        help="Segments with a higher compression ratio (repeated text) are transcribed again")
+    parser.add_argument("--cascade-no-speech", dest="cascade_no_speech", type=float, default=0.6,
+                        help="Low confidence segments with a higher no speech probability are silence and kept")
+    parser.add_argument("--batch", dest="batch", type=str, default=None,
+                        help="Path to a manifest of audio files to process, one per line ('-' reads stdin). Results are written as json lines")
+    parser.add_argument("--vad", dest="vad", action="store_true", default=False,
+                        help="Only transcribe the speech regions found by voice activity detection")
+    parser.add_argument("--vad-threshold", dest="vad_threshold", type=float, default=-45.0,
+                        help="Loudness in dBFS above which audio counts as speech")
+    parser.add_argument("--vad-min-silence", dest="vad_min_silence", type=float, default=1.0,
+                        help="Shortest silence in seconds that is skipped")
+    parser.add_argument("--chunk-workers", dest="chunk_workers", type=int, default=None,
+                        help="Transcribe recordings longer than --chunk-seconds in chunks on this many processes")
+    parser.add_argument("--chunk-seconds", dest="chunk_seconds", type=float, default=300.0,
+                        help="Longest chunk of a chunked transcription in seconds, chunks are cut at silences")
+    parser.add_argument("--chunk-overlap", dest="chunk_overlap", type=float, default=2.0,
+                        help="Overlap between chunks in seconds")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=8,
+                        help="Maximum number of manifest lines processed together, words requests are decoded as one batch")
+    parser.add_argument("--batch-max-mb", dest="batch_max_mb", type=int, default=1024,
+                        help="Memory cap in MB of the spectrograms and encoder output of a decoding batch")
+    parser.add_argument("--serve", dest="serve", type=str, default=None,
+                        help="Run as a daemon serving requests on the given unix socket path")
+    parser.add_argument("--queue-size", dest="queue_size", type=int, default=8,
+                        help="Maximum number of requests waiting in the daemon queue")
+    parser.add_argument("--threads", dest="threads", type=int, default=None,
+                        help="Number of cpu threads torch uses, defaults to all cores")
+    parser.add_argument("--model-cache-mb", dest="model_cache_mb", type=int, default=None,
+                        help="Memory budget of the loaded models in MB, least recently used models are unloaded first")
+    parser.add_argument("--cache-dir", dest="cache_dir", type=str, default=None,
+                        help="Directory of the persistent result cache, keyed by audio content, model and options")
+    parser.add_argument("--audio-cache-mb", dest="audio_cache_mb", type=int, default=4096,
+                        help="Maximum size in MB of the decoded audio kept in --cache-dir, 0 disables the audio cache")
+    parser.add_argument("--cache-max-mb", dest="cache_max_mb", type=int, default=1024,
+                        help="Maximum size of the result cache in MB, least recently used results are removed first")
+    parser.add_argument("--metrics", dest="metrics", action="store_true", default=False,
+                        help="Report the seconds spent in each stage, the audio seconds and peak memory of every request as json, "
+                             "on stderr for a single file and in the responses of batch and daemon requests")
     parser.add_argument("--download-models", dest="download_models", action="store_true", default=False, help="Download whisper AI models")
     parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
 
     args = parser.parse_args()
+    if args.output == stream_output and args.chunk_workers:
+        parser.error(f"--chunk-workers can't be used with --output {stream_output}, streamed chunks are transcribed in order")
 
     start_time = datetime.datetime.now()
     if args.verbose:
         print(f'\nStarted running script: {start_time}', file = sys.stderr)
 
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.model_cache_mb:
+        model_cache.budget_bytes = args.model_cache_mb * 1024 * 1024
+    if args.cache_dir:
+        result_cache = ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    if args.cache_dir and args.audio_cache_mb:
+        audio_cache = AudioCache(args.cache_dir, args.audio_cache_mb * 1024 * 1024)
+    words_window = min(args.words_window, CHUNK_LENGTH)
+    if args.vad:
+        vad_options = {"threshold_db": args.vad_threshold, "min_silence": args.vad_min_silence}
+    if args.chunk_workers:
+        chunk_options = {"workers": args.chunk_workers, "chunk_seconds": args.chunk_seconds, "overlap": args.chunk_overlap}
+    precision = args.precision
+    if args.cascade_model:
+        cascade_options = {"model": args.cascade_model, "logprob": args.cascade_logprob,
+                           "compression": args.cascade_compression, "no_speech": args.cascade_no_speech}
+    collect_metrics = args.metrics
+    if precision == "bf16" and not bf16_supported():
+        print("WARNING!: the cpu has no bfloat16 instructions, using fp32", file = sys.stderr)
+        precision = "fp32"
+
     if args.download_models:
         for m in model_choices:
             model = whisper.load_model(m, download_root=models)
+            checkpoint_verified(checkpoint_path(m, models), whisper._MODELS[m])
         if args.verbose:
             print("Downloaded enabled models")
             print(f'\nFinished running script: {datetime.datetime.now()}\nTime elapsed: {datetime.datetime.now() - start_time}', file=sys.stderr)
         exit(0)
 
-    # copy file to transcribe
-    with open(f"/app/tmp/audio.{args.audio_ext}", 'wb') as output_file: # open in binary mode
-            while True:
-                chunk = sys.stdin.buffer.read(4096)  # Read in chunks (4KB)
-                if not chunk:
-                    break  # End of input
-                output_file.write(chunk)
+    defaults = {"output": args.output, "model": args.model, "lang": args.lang, "get_words": args.get_words,
+                "audio_file_ext": args.audio_ext}
+
+    if args.serve:
+        serve(args.serve, models, defaults, args.queue_size)
+        if args.verbose:
+            print(f'\nFinished running script: {datetime.datetime.now()}\nTime elapsed: {datetime.datetime.now() - start_time}', file=sys.stderr)
+        exit(0)
 
-    audio_file = f"/app/tmp/audio.{args.audio_ext}"
+    if args.batch:
+        batch_max_bytes = args.batch_max_mb * 1024 * 1024
+        if args.batch == "-":
+            done = run_batch(sys.stdin, models, defaults, args.batch_size, batch_max_bytes)
+        else:
+            with open(args.batch, "r") as manifest_file:
+                done = run_batch(manifest_file, models, defaults, args.batch_size, batch_max_bytes)
+        if args.verbose:
+            print(f"Processed {done} files in batch", file = sys.stderr)
+            print(f"Model cache: {json.dumps(model_cache.stats())}", file = sys.stderr)
+            print(f"Result cache: {json.dumps(result_cache.stats())}", file = sys.stderr)
+            print(f"Audio cache: {json.dumps(audio_cache.stats())}", file = sys.stderr)
+            print(f'\nFinished running script: {datetime.datetime.now()}\nTime elapsed: {datetime.datetime.now() - start_time}', file=sys.stderr)
+        exit(0)
 
-    # get name
-    if args.output == "words":
-        words = get_first_words(audio_file, models, args.get_words, args.lang, args.model)
-        print(" ".join(words))
+    # decode the audio straight from stdin, with a cache keep it in memory and only decode it on a cache miss
+    metrics = start_metrics()
+    if cache_enabled():
+        with stage("read"):
+            data = sys.stdin.buffer.read()
+        audio_hash = hash_audio(data)
+        audio = lambda: decode_audio(data, args.audio_ext)
     else:
-        # get transcription
-        trans = get_transcription(audio_file, models, args.lang, args.model)
+        audio_hash = None
+        with stage("load_audio"):
+            audio = decode_audio(sys.stdin.buffer, args.audio_ext)
+        note_audio(audio)
 
-        if args.output == "text":
-            print(trans["text"])
-        elif args.output == "json":
-            json.dump(trans, sys.stdout, indent=2)
-        else:
-            print("bad output mode")
-            exit(1)
+    if args.output == stream_output:
+        stream_transcription(audio, models, args.lang, args.model, audio_hash, args.stream_chunk_seconds)
+    else:
+        result = run_request(audio, args.output, models, args.get_words, args.lang, args.model, audio_hash)
+        with stage("output"):
+            sys.stdout.write(format_output(args.output, result))
+            sys.stdout.flush()
+    if metrics:
+        print(json.dumps({"metrics": metrics.as_dict()}), file = sys.stderr)
 
 
     if args.verbose:
@@ -0,0 +1,331 @@
+import os
+import sys
+import argparse
+import datetime
+import json
+import subprocess
+import time
+import wave
+import numpy as np
+import torch
+import whisper
+import alchemize
+from whisper.normalizers import BasicTextNormalizer, EnglishTextNormalizer
+
+
+def word_errors(reference, hypothesis):
+    """Word level edit distance between two lists of words."""
+    row = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, 1):
+        prev, row[0] = row[0], i
+        for j, hyp_word in enumerate(hypothesis, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ref_word != hyp_word))
+    return row[-1]
+
+
+def word_error_rate(references, hypotheses, normalizer):
+    """Word error rate of the hypotheses over all references, texts are normalized before comparing."""
+    errors = 0
+    words = 0
+    for reference, hypothesis in zip(references, hypotheses):
+        ref_words = normalizer(reference).split()
+        errors += word_errors(ref_words, normalizer(hypothesis).split())
+        words += len(ref_words)
+    return round(errors / words, 4) if words else 0.0
+
+
+def reference_text(audio_file):
+    """Text of a reference transcript next to the audio file (<name>.txt), None when there isn't one."""
+    path = os.path.splitext(audio_file)[0] + ".txt"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as reference_file:
+        return reference_file.read()
+
+
+def run_precision(precision, audio, model_name, trans_language, repeat):
+    """Load the model and transcribe every audio in precision, the fastest of repeat runs is reported."""
+    alchemize.precision = precision
+    alchemize.model_cache = alchemize.ModelCache()
+    converted = precision == "int8" and not os.path.exists(alchemize.quantized_path(model_name, alchemize.models))
+
+    start = time.perf_counter()
+    alchemize.load_model(model_name, alchemize.models)
+    load_seconds = time.perf_counter() - start
+
+    texts = []
+    transcribe_seconds = 0.0
+    for samples in audio:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            text = alchemize.transcribe_samples(samples, alchemize.models, trans_language, model_name)["text"]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        texts.append(text)
+        transcribe_seconds += best
+
+    return {"load_seconds": round(load_seconds, 3),
+            "converted": converted,
+            "transcribe_seconds": round(transcribe_seconds, 3),
+            "bytes": alchemize.model_cache.stats()["bytes"]}, texts
+
+
+def compare_precisions(audio_files, model_name, trans_language, precisions, repeat):
+    """
+    Transcribe the audio files in every precision and compare speed and word error rate to fp32.
+
+    The word error rate against fp32 shows what a precision changes, files with a reference transcript
+    also get the word error rate against the reference.
+    """
+    audio = [alchemize.load_samples(audio_file) for audio_file in audio_files]
+    audio_seconds = sum(len(samples) for samples in audio) / whisper.audio.SAMPLE_RATE
+    references = [reference_text(audio_file) for audio_file in audio_files]
+    normalizer = EnglishTextNormalizer() if trans_language == "en" else BasicTextNormalizer()
+
+    results = {}
+    texts = {}
+    for precision in ["fp32"] + [p for p in precisions if p != "fp32"]:
+        if args.verbose:
+            print(f"Transcribing {len(audio)} files with {model_name} in {precision}", file = sys.stderr)
+        results[precision], texts[precision] = run_precision(precision, audio, model_name, trans_language, repeat)
+
+    for precision, result in results.items():
+        result["rtf"] = round(result["transcribe_seconds"] / audio_seconds, 4) if audio_seconds else None
+        result["speedup"] = round(results["fp32"]["transcribe_seconds"] / result["transcribe_seconds"], 3)
+        result["wer_vs_fp32"] = word_error_rate(texts["fp32"], texts[precision], normalizer)
+        if all(reference is not None for reference in references):
+            result["wer"] = word_error_rate(references, texts[precision], normalizer)
+
+    return {"model": model_name,
+            "files": len(audio_files),
+            "audio_seconds": round(audio_seconds, 3),
+            "precisions": results}
+
+
+def write_fixture(path, seconds, sr=whisper.audio.SAMPLE_RATE):
+    """
+    Write a synthetic speech-like recording: voiced bursts of a few harmonics with a moving pitch,
+    separated by short pauses and a quiet noise floor. Other extensions than wav are encoded from a wav with ffmpeg.
+    """
+    base, ext = os.path.splitext(path)
+    if ext != ".wav":
+        wav_path = write_fixture(base + ".wav", seconds, sr)
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", wav_path, path], check=True)
+        return path
+
+    rng = np.random.default_rng(int(seconds))
+    t = np.arange(int(seconds * sr)) / sr
+    pitch = 120 + 40 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sr
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    # 0.4 second syllables, every fourth one is a pause
+    syllable = (t // 0.4).astype(int)
+    envelope = np.where(syllable % 4 == 3, 0.0, np.sin(np.pi * (t % 0.4) / 0.4))
+    audio = 0.3 * voice * envelope + 0.003 * rng.standard_normal(len(t))
+
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sr)
+        wav_file.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+    return path
+
+
+def fixtures(fixture_dir, durations):
+    """Synthetic fixtures in fixture_dir for every duration, as wav and as m4a to include an aac decode."""
+    os.makedirs(fixture_dir, exist_ok=True)
+    paths = []
+    for seconds in durations:
+        for ext in ["wav", "m4a"]:
+            path = os.path.join(fixture_dir, f"fixture-{seconds:g}s.{ext}")
+            paths.append(path if os.path.exists(path) else write_fixture(path, seconds))
+    return paths
+
+
+def timed(func, *func_args):
+    """Run func and return its result with the seconds it took."""
+    start = time.perf_counter()
+    result = func(*func_args)
+    return result, time.perf_counter() - start
+
+
+def stage_timings(model_name, audio_file, trans_language):
+    """
+    Time every stage of transcribing audio_file with model_name, on a freshly loaded model.
+
+    The mel, encoder and decoder stages are timed on the first 30 second window, end_to_end is a full
+    text request including decoding the file again.
+    """
+    alchemize.model_cache = alchemize.ModelCache()
+    model, load_seconds = timed(alchemize.load_model, model_name, alchemize.models)
+    audio, decode_seconds = timed(alchemize.load_samples, audio_file)
+
+    with torch.no_grad(), alchemize.inference_context(model):
+        window = whisper.pad_or_trim(audio)
+        mel, mel_seconds = timed(whisper.log_mel_spectrogram, window, model.dims.n_mels)
+        audio_features, encoder_seconds = timed(model.embed_audio, mel[None].to(model.device))
+        language = "en" if model_name.endswith(".en") else trans_language
+        options = whisper.DecodingOptions(fp16 = False, language=language)
+        decoded, decoder_seconds = timed(whisper.decode, model, audio_features, options)
+
+    _, end_to_end_seconds = timed(alchemize.run_request, audio_file, "text", alchemize.models, 4, language,
+                                  model_name)
+    audio_seconds = len(audio) / whisper.audio.SAMPLE_RATE
+
+    return {"model": model_name,
+            "fixture": os.path.basename(audio_file),
+            "audio_seconds": round(audio_seconds, 3),
+            "load_seconds": round(load_seconds, 3),
+            "decode_seconds": round(decode_seconds, 3),
+            "mel_seconds": round(mel_seconds, 3),
+            "encoder_seconds": round(encoder_seconds, 3),
+            "decoder_seconds": round(decoder_seconds, 3),
+            "decoded_tokens": len(decoded[0].tokens),
+            "end_to_end_seconds": round(end_to_end_seconds, 3),
+            "rtf": round(end_to_end_seconds / audio_seconds, 4) if audio_seconds else None}
+
+
+def run_stages(audio_files, model_names, trans_language):
+    """Stage timings of every model on every audio file, with the settings they were measured with."""
+    results = []
+    for model_name in model_names:
+        for audio_file in audio_files:
+            if args.verbose:
+                print(f"Benchmarking {model_name} on {os.path.basename(audio_file)}", file = sys.stderr)
+            results.append(stage_timings(model_name, audio_file, trans_language))
+
+    return {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "precision": alchemize.precision,
+            "results": results}
+
+
+def run_seconds(cmd, repeat, stdin_path=None):
+    """Fastest wall time of repeat runs of cmd, with the file stdin_path as its stdin."""
+    best = None
+    for _ in range(repeat):
+        with open(stdin_path if stdin_path else os.devnull, "rb") as stdin:
+            _, elapsed = timed(lambda: subprocess.run(cmd, stdin=stdin, stdout=subprocess.DEVNULL,
+                                                      stderr=subprocess.DEVNULL))
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 3)
+
+
+def startup_timings(model_name, fixture, repeat):
+    """
+    Startup costs of alchemize.py: --help and a bad argument, importing torch and whisper, loading the model
+    with whisper.load_model and from its verified memory mapped checkpoint, and a words request on fixture
+    in a fresh process.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alchemize.py")
+    python = sys.executable
+    # the first load downloads and verifies the checkpoint
+    alchemize.load_whisper_model(model_name, "cpu", alchemize.models)
+    whisper_load = min(timed(whisper.load_model, model_name, "cpu", alchemize.models)[1] for _ in range(repeat))
+    verified_load = min(timed(alchemize.load_whisper_model, model_name, "cpu", alchemize.models)[1]
+                        for _ in range(repeat))
+
+    return {"model": model_name,
+            "help_seconds": run_seconds([python, script, "--help"], repeat),
+            "bad_args_seconds": run_seconds([python, script, "--model", "none"], repeat),
+            "import_seconds": run_seconds([python, "-c", "import torch, whisper"], repeat),
+            "whisper_load_seconds": round(whisper_load, 3),
+            "verified_load_seconds": round(verified_load, 3),
+            "first_words_seconds": run_seconds([python, script, "--model", model_name, "--output", "words",
+                                                "--audio-file-ext", "wav"], repeat, fixture)}
+
+
+def regressions(report, baseline, tolerance):
+    """
+    Stage timings of report that are more than tolerance (a fraction) slower than the same model and fixture
+    in baseline. Returns a list of regressions with the baseline and current seconds.
+    """
+    # the suite report of benchmark.clj keeps this report under stages
+    baseline = baseline.get("stages", baseline)
+    previous = {(result["model"], result["fixture"]): result for result in baseline["results"]}
+    found = []
+    for result in report["results"]:
+        before = previous.get((result["model"], result["fixture"]))
+        if before is None:
+            continue
+        for stage, seconds in result.items():
+            if stage.endswith("_seconds") and stage != "audio_seconds" and before.get(stage):
+                if seconds > before[stage] * (1 + tolerance):
+                    found.append({"model": result["model"], "fixture": result["fixture"], "stage": stage,
+                                  "baseline": before[stage], "seconds": seconds})
+    return found
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark whispering alchemy.")
+    verbose_parser = argparse.ArgumentParser(add_help=False)
+    verbose_parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    precision_parser = subparsers.add_parser("precision", parents=[verbose_parser],
+                                             help="Compare the speed and word error rate of the inference precisions")
+    precision_parser.add_argument("audio_files", nargs="+", help="Audio files to transcribe, <name>.txt next to a file is its reference transcript")
+    precision_parser.add_argument("--model", type=str, default="base", choices=alchemize.model_choices, help="Whisper model")
+    precision_parser.add_argument("--lang", type=str, default="en", help="Language of transcription")
+    precision_parser.add_argument("--precision", dest="precisions", type=str, nargs="+", default=alchemize.precision_choices,
+                                  choices=alchemize.precision_choices, help="Precisions to compare with fp32")
+    precision_parser.add_argument("--repeat", type=int, default=1, help="Transcribe every file this many times and keep the fastest")
+
+    stages_parser = subparsers.add_parser("stages", parents=[verbose_parser],
+                                          help="Time every stage of the pipeline per model, as json")
+    stages_parser.add_argument("audio_files", nargs="*", help="Audio files to benchmark, synthetic fixtures when none are given")
+    stages_parser.add_argument("--model", dest="models", type=str, nargs="+", default=alchemize.model_choices,
+                               choices=alchemize.model_choices, help="Whisper models to benchmark")
+    stages_parser.add_argument("--lang", type=str, default="en", help="Language of transcription")
+    stages_parser.add_argument("--precision", type=str, default="fp32", choices=alchemize.precision_choices,
+                               help="Precision of cpu inference")
+    stages_parser.add_argument("--fixture-seconds", dest="fixture_seconds", type=float, nargs="+", default=[10, 60],
+                               help="Durations of the synthetic fixtures")
+    stages_parser.add_argument("--fixture-dir", dest="fixture_dir", type=str, default=os.path.join(alchemize.tmp_dir, "fixtures"),
+                               help="Directory the synthetic fixtures are written to")
+    stages_parser.add_argument("--output", type=str, default=None, help="Also write the report to this file")
+    stages_parser.add_argument("--baseline", type=str, default=None,
+                               help="Report of an earlier run, stages slower than it by more than --tolerance fail the run")
+    stages_parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown compared to the baseline, as a fraction")
+
+    startup_parser = subparsers.add_parser("startup", parents=[verbose_parser],
+                                           help="Time the startup of alchemize.py and loading a model, as json")
+    startup_parser.add_argument("--model", type=str, default="base", choices=alchemize.model_choices, help="Whisper model")
+    startup_parser.add_argument("--repeat", type=int, default=3, help="Run every step this many times and keep the fastest")
+    startup_parser.add_argument("--fixture-dir", dest="fixture_dir", type=str, default=os.path.join(alchemize.tmp_dir, "fixtures"),
+                                help="Directory the synthetic fixture is written to")
+
+    args = parser.parse_args()
+    alchemize.args = args
+
+    if args.benchmark == "startup":
+        report = startup_timings(args.model, fixtures(args.fixture_dir, [10])[0], args.repeat)
+        sys.stdout.write(json.dumps(report, indent=2) + "\n")
+        exit(0)
+
+    if args.benchmark == "precision":
+        precisions = args.precisions
+        if "bf16" in precisions and not alchemize.bf16_supported():
+            print("WARNING!: the cpu has no bfloat16 instructions, skipping bf16", file = sys.stderr)
+            precisions = [p for p in precisions if p != "bf16"]
+
+        report = compare_precisions(args.audio_files, args.model, args.lang, precisions, args.repeat)
+        sys.stdout.write(json.dumps(report, indent=2) + "\n")
+        exit(0)
+
+    alchemize.precision = args.precision
+    audio_files = args.audio_files or fixtures(args.fixture_dir, args.fixture_seconds)
+    report = run_stages(audio_files, args.models, args.lang)
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            report["regressions"] = regressions(report, json.load(baseline_file), args.tolerance)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    if report.get("regressions"):
+        print(f"{len(report['regressions'])} stages are slower than the baseline", file = sys.stderr)
+        exit(1)
@@ -0,0 +1,128 @@
+(ns sorting
+  (:require [babashka.fs :as fs]
+            [clojure.string :as str]
+            [file-index :as fi]))
+
+;; name of a renamed recording: date, optional time and count, its first words and extension
+(def renamed-pattern #"(\d{4})-(\d{2})-(\d{2})(?:_(\d{4}))?(?:_\d{2})?_(.*)\.(wav|mp3|m4a|aac|flac)")
+;; name of the index of destination directories, kept in the sorted directory
+(def destinations-name ".alchemy-destinations.edn")
+;; directories of the logseq graph recordings are linked from and moved to
+(def journals-dir "journals")
+(def assets-dir "assets/voicenotes")
+
+(defn parse-name
+  "Returns the date, time and lower case words of a renamed recording, nil when the name doesn't have the renamed format."
+  [file-name]
+  (when-let [[_ yyyy mm dd tttt words ext] (re-matches renamed-pattern file-name)]
+    {:date (str yyyy "-" mm "-" dd)
+     :journal (str yyyy "_" mm "_" dd ".md")
+     :time tttt
+     :words (str/lower-case (str/replace words "-" " "))
+     :ext ext}))
+
+(defn- compile-rule
+  "Compiles a rule of the config into the rule with a :match? function of a parsed recording and its transcript.
+   A rule matches when the words start with one of its :keywords, one of its :regexes is found in the words or
+   the transcript and the date is between :from and :to (yyyy-mm-dd, inclusive).
+   Conditions a rule doesn't have always match."
+  [kind [rule-name {:keys [keywords regexes from to] :as rule}]]
+  (let [keywords (mapv str/lower-case keywords)
+        patterns (mapv #(re-pattern (str "(?i)" %)) regexes)
+        match? (fn [{:keys [date words]} transcript]
+                 (boolean
+                  (and (or (empty? keywords) (some #(str/starts-with? words %) keywords))
+                       (or (empty? patterns) (some #(or (re-find % words) (and transcript (re-find % transcript))) patterns))
+                       (or (nil? from) (not (neg? (compare date from))))
+                       (or (nil? to) (not (pos? (compare date to)))))))]
+    (assoc rule :name rule-name :kind kind :match? match?)))
+
+(defn compile-rules
+  "Compiles the :folders and the logseq :tags rules of config once for a whole run, folder rules are tried first.
+   Rules are tried in the order of the config, give them as a vector of [name rule] pairs when a map is too big
+   to keep its order. Folder rules are skipped when [:sorting :enable] is false, tags unless [:logseq :enable]."
+  [config]
+  (concat (when (get-in config [:sorting :enable] true)
+            (map #(compile-rule :folder %) (:folders config)))
+          (when (get-in config [:logseq :enable])
+            (map #(compile-rule :logseq %) (:tags config)))))
+
+(defn match-rule
+  "Returns the first of rules matching a parsed recording and its transcript, nil when none match."
+  [rules parsed transcript]
+  (some #(when ((:match? %) parsed transcript) %) rules))
+
+(defn- dir-mtime
+  "Returns the mtime of dir in milliseconds."
+  [dir]
+  (fs/file-time->millis (fs/last-modified-time dir)))
+
+(defn load-destinations
+  "Reads the destination index of dir, a map of destination directory to its mtime and file names."
+  [dir]
+  (atom (fi/load-index dir destinations-name)))
+
+(defn save-destinations
+  "Writes the destination index to dir with the current mtime of every destination,
+   so the files this run moved in don't make the next run list them again."
+  [dir destinations]
+  (fi/save-index dir
+                 (into {}
+                       (for [[k entry] @destinations
+                             :when (fs/directory? k)]
+                         [k (-> entry (dissoc :listed) (assoc :mtime (dir-mtime k)))]))
+                 destinations-name))
+
+(defn names!
+  "Returns the file names in dir from the destination index. dir is listed at most once per run,
+   and only when it changed since it was indexed."
+  [destinations dir]
+  (let [k (str (fs/absolutize dir))]
+    (swap! destinations
+           (fn [index]
+             (let [{:keys [mtime listed]} (get index k)]
+               (cond
+                 listed index
+                 (= mtime (dir-mtime dir)) (assoc-in index [k :listed] true)
+                 :else (assoc index k {:listed true
+                                       :names (into #{} (map (comp str fs/file-name)) (fs/list-dir dir))})))))
+    (get-in @destinations [k :names])))
+
+(defn add-name!
+  "Adds file-name to the names of dir in the destination index."
+  [destinations dir file-name]
+  (swap! destinations update-in [(str (fs/absolutize dir)) :names] (fnil conj #{}) file-name))
+
+(defn claim-name!
+  "Returns file-name, or file-name with a _n count when dir already has it, and adds it to the names of dir."
+  [destinations dir file-name]
+  (let [names (names! destinations dir)
+        [base-name ext] (fs/split-ext file-name)
+        free-name (->> (range)
+                       (map #(if (zero? %) file-name (str base-name "_" % "." ext)))
+                       (remove names)
+                       first)]
+    (add-name! destinations dir free-name)
+    free-name))
+
+(defn journal-block
+  "Returns the logseq journal block of a recording moved to the assets, with the tag of rule and the transcript."
+  [{:keys [tag-str transcribe]} intake-tag asset-name transcript]
+  (str "- "
+       (when (seq tag-str) (str "[[" tag-str "]] "))
+       (when (seq intake-tag) (str "[[" intake-tag "]]"))
+       "\n    - ![voice recording](../" assets-dir "/" asset-name ")"
+       (when (and transcribe (seq transcript)) (str "\n    - " transcript))))
+
+(defn append-journals
+  "Appends blocks, a map of journal page name to its blocks, to the journal pages of logseq-dir with one write per page.
+   Blocks added to an existing page are separated from its content by an empty block."
+  [destinations logseq-dir blocks]
+  (let [dir (fs/path logseq-dir journals-dir)]
+    (fs/create-dirs dir)
+    (doseq [[journal page-blocks] blocks
+            :let [exists? (contains? (names! destinations dir) journal)]]
+      (spit (str (fs/path dir journal))
+            (str (when exists? "\n-\n") (str/join "\n-\n" page-blocks))
+            :append true)
+      (add-name! destinations dir journal))))
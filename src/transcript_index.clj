@@ -0,0 +1,164 @@
+(ns transcript-index
+  (:require [babashka.fs :as fs]
+            [babashka.pods :as pods]
+            [cheshire.core :as json]
+            [clojure.string :as str]
+            [file-index :as fi]))
+
+;; name of the search database kept in every indexed directory
+(def db-name ".alchemy-search.db")
+;; segments of a transcript get the docids (id << segment-bits) + n, so a transcript is replaced with a docid range
+(def segment-bits 20)
+;; segments inserted with a single statement
+(def insert-rows 200)
+
+(def ^:private sqlite
+  (delay
+    (pods/load-pod 'org.babashka/go-sqlite3 "0.2.3")
+    {:execute! (requiring-resolve 'pod.babashka.go-sqlite3/execute!)
+     :query (requiring-resolve 'pod.babashka.go-sqlite3/query)}))
+
+;; databases whose tables were created by this process
+(def ^:private ready-dbs (atom #{}))
+
+(defn- execute! [db & sql-params] ((:execute! @sqlite) db (vec sql-params)))
+(defn- select-rows [db & sql-params] ((:query @sqlite) db (vec sql-params)))
+
+(defn- db
+  "Returns the path of the search database of dir, creating its tables when they don't exist yet.
+   Segments are kept in an fts4 table, fts5 isn't part of the sqlite of the go-sqlite3 pod."
+  [dir]
+  (let [path (str (fs/path dir db-name))]
+    (when-not (contains? @ready-dbs path)
+      (execute! path (str "CREATE TABLE IF NOT EXISTS transcripts (id INTEGER PRIMARY KEY, name TEXT UNIQUE, "
+                          "recording TEXT, model TEXT, source TEXT, size INTEGER, mtime INTEGER)"))
+      (execute! path (str "CREATE VIRTUAL TABLE IF NOT EXISTS segments USING fts4(text, start_ms, end_ms, "
+                          "notindexed=start_ms, notindexed=end_ms)"))
+      (swap! ready-dbs conj path))
+    path))
+
+(defn sidecar
+  "Returns the path of the sidecar file of recording with the transcription of model and extension ext."
+  [recording model ext]
+  (let [[base-name _] (fs/split-ext (fs/file-name recording))]
+    (fs/path (fs/parent (fs/absolutize recording)) (str base-name "." model "." ext))))
+
+(defn- transcript-name
+  "Returns the name a transcript of recording by model is indexed under, the name of its sidecars without extension."
+  [recording model]
+  (let [[base-name _] (fs/split-ext (fs/file-name recording))]
+    (str base-name "." model)))
+
+(defn- source
+  "Returns the sidecar the transcript of recording by model is indexed from: the .json with the segments
+   of a json result when there is one, otherwise the .txt transcription."
+  [recording model]
+  (let [json-file (sidecar recording model "json")]
+    (if (fs/exists? json-file) json-file (sidecar recording model "txt"))))
+
+(defn- read-segments
+  "Returns the segments of source with their offsets in milliseconds.
+   A .txt transcription has no timestamps and is a single segment at offset 0."
+  [source]
+  (if (= "json" (fs/extension source))
+    (for [{:keys [start end text]} (:segments (json/parse-string (slurp (str source)) true))]
+      {:start-ms (Math/round (* 1000.0 start)) :end-ms (Math/round (* 1000.0 end)) :text (str/trim text)})
+    [{:start-ms 0 :end-ms 0 :text (str/trim (slurp (str source)))}]))
+
+(defn index-transcript!
+  "Adds the transcript of recording by model to the search database of its directory,
+   replacing what was indexed for it before."
+  [recording model]
+  (let [dir (fs/parent (fs/absolutize recording))
+        path (db dir)
+        source (source recording model)
+        {:keys [size mtime]} (fi/file-stat source)
+        name (transcript-name recording model)]
+    (execute! path (str "INSERT INTO transcripts (name, recording, model, source, size, mtime) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET recording = excluded.recording, source = excluded.source, "
+                        "size = excluded.size, mtime = excluded.mtime")
+              name (str (fs/file-name recording)) model (str (fs/file-name source)) size mtime)
+    (let [id (:id (first (select-rows path "SELECT id FROM transcripts WHERE name = ?" name)))
+          first-docid (bit-shift-left id segment-bits)]
+      (execute! path "DELETE FROM segments WHERE docid BETWEEN ? AND ?"
+                first-docid (dec (bit-shift-left (inc id) segment-bits)))
+      (doseq [rows (partition-all insert-rows (map-indexed vector (remove (comp str/blank? :text) (read-segments source))))]
+        (apply execute! path
+               (str "INSERT INTO segments (docid, text, start_ms, end_ms) VALUES "
+                    (str/join ", " (repeat (count rows) "(?, ?, ?, ?)")))
+               (mapcat (fn [[n {:keys [start-ms end-ms text]}]] [(+ first-docid n) text start-ms end-ms]) rows))))))
+
+(defn- remove-transcript!
+  "Removes a transcript that is no longer in dir from its search database."
+  [path id]
+  (execute! path "DELETE FROM segments WHERE docid BETWEEN ? AND ?"
+            (bit-shift-left id segment-bits) (dec (bit-shift-left (inc id) segment-bits)))
+  (execute! path "DELETE FROM transcripts WHERE id = ?" id))
+
+(defn- transcripts
+  "Returns the transcripts in dir, listed once: a map of name to the recording and model of every .txt transcription
+   next to an audio file."
+  [dir]
+  (let [files (map (comp str fs/file-name) (fs/list-dir dir))
+        recordings (into {}
+                         (keep #(let [[base-name ext] (fs/split-ext %)]
+                                  (when (#{"mp3" "wav" "m4a" "aac" "flac"} ext) [base-name %])))
+                         files)]
+    (into {}
+          (for [file files
+                :when (str/ends-with? file ".txt")
+                :let [stem (subs file 0 (- (count file) 4))
+                      ;; the base name of the recording is the longest prefix of the stem ending before a dot
+                      split (some #(when (contains? recordings (subs stem 0 %)) %)
+                                  (reverse (keep-indexed (fn [i c] (when (= \. c) i)) stem)))]
+                :when split]
+            [stem {:recording (fs/path dir (recordings (subs stem 0 split)))
+                   :model (subs stem (inc split))}]))))
+
+(defn reindex
+  "Brings the search database of dir up to date with its transcripts. Only transcripts whose source sidecar is new
+   or changed size or mtime are indexed again, transcripts that are gone are removed.
+   Returns the number of :indexed, :removed and :unchanged transcripts."
+  [dir]
+  (let [path (db dir)
+        indexed (into {} (map (juxt :name identity)) (select-rows path "SELECT id, name, source, size, mtime FROM transcripts"))
+        present (transcripts dir)
+        changed (for [[name {:keys [recording model]}] present
+                      :let [source (source recording model)
+                            before (get indexed name)]
+                      :when (not= [(str (fs/file-name source)) (fi/file-stat source)]
+                                  [(:source before) (select-keys before [:size :mtime])])]
+                  [recording model])
+        gone (remove #(contains? present (:name %)) (vals indexed))]
+    (doseq [[recording model] changed]
+      (index-transcript! recording model))
+    (doseq [{:keys [id]} gone]
+      (remove-transcript! path id))
+    {:indexed (count changed) :removed (count gone) :unchanged (- (count present) (count changed))}))
+
+(defn search
+  "Finds the segments matching an fts query (words, \"phrases\", prefix*, AND/OR/NOT) in the transcripts of dir,
+   a directory or a list of them, which are reindexed first.
+   Returns the matching recordings with the model of the transcript and the offsets of the matching segments in
+   milliseconds, and prints them. Takes a map so it can be called with
+   bb -x transcript-index/search --dir ~/recordings --query '\"dentist appointment\"'."
+  [{:keys [dir query limit] :or {limit 100}}]
+  (let [dirs (if (string? dir) [dir] dir)
+        results (for [d dirs
+                      :let [_ (reindex d)
+                            rows (select-rows (db d)
+                                        (str "SELECT transcripts.recording, transcripts.model, "
+                                             "CAST(segments.start_ms AS INTEGER) AS start_ms, "
+                                             "CAST(segments.end_ms AS INTEGER) AS end_ms, segments.text "
+                                             "FROM segments JOIN transcripts ON transcripts.id = (segments.docid >> ?) "
+                                             "WHERE segments MATCH ? ORDER BY transcripts.recording, start_ms LIMIT ?")
+                                        segment-bits (str query) limit)]
+                      [[recording model] matches] (group-by (juxt :recording :model) rows)]
+                  {:recording (str (fs/path d recording))
+                   :model model
+                   :offsets (mapv #(hash-map :start-ms (:start_ms %) :end-ms (:end_ms %) :text (:text %)) matches)})
+        results (vec (sort-by :recording results))]
+    (doseq [{:keys [recording model offsets]} results
+            {:keys [start-ms text]} offsets]
+      (println (str recording " [" model "] " start-ms "ms: " text)))
+    results))
@@ -0,0 +1,36 @@
+(ns file-processing-test
+  (:require [babashka.fs :as fs]
+            [clojure.test :refer [deftest is testing]]
+            [file-index :as fi]
+            [file-processing]
+            [sorting]))
+
+(def ^:private config {:logseq {:enable true}
+                       :tags [[:health {:keywords ["health"] :tag-str "health" :transcribe true}]]})
+
+(defn- sort-names [entry]
+  (let [index (atom {"/recordings/2024-03-05_1230_health-check.mp3" (merge {:mtime 0 :size 1000} entry)})]
+    (mapv (comp str :file) (#'file-processing/sort-jobs index (sorting/compile-rules config) 0 "base"))))
+
+(deftest sort-jobs-test
+  (testing "recordings wait for their transcription"
+    (is (= [] (sort-names {}))))
+  (testing "recordings that won't get a transcription are sorted without it"
+    (is (= ["/recordings/2024-03-05_1230_health-check.mp3"]
+           (sort-names {:size-rejected (#'file-processing/size-limits)})))
+    (is (= ["/recordings/2024-03-05_1230_health-check.mp3"] (sort-names {:quarantined "base"}))))
+  (testing "recordings rejected under other limits or quarantined by another stage still wait"
+    (is (= [] (sort-names {:size-rejected [0 1 false]})))
+    (is (= [] (sort-names {:quarantined :sort})))))
+
+(deftest next-retry-test
+  (let [dir (fs/create-temp-dir)
+        now (System/currentTimeMillis)]
+    (try
+      (is (nil? (#'file-processing/next-retry dir)))
+      (fi/save-index dir {"/a.mp3" {:retry-at {:rename (+ now 60000) "base" (+ now 30000)}}
+                          "/b.mp3" {:retry-at {:rename (- now 1000)}}
+                          "/c.mp3" {:retry-at {:rename (+ now 1000)} :quarantined :rename}})
+      (is (= (+ now 30000) (#'file-processing/next-retry dir))
+          "retries that passed and quarantined files don't wake the watch")
+      (finally (fs/delete-tree dir)))))
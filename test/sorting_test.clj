@@ -0,0 +1,46 @@
+(ns sorting-test
+  (:require [babashka.fs :as fs]
+            [clojure.test :refer [deftest is testing]]
+            [sorting]))
+
+(deftest parse-name-test
+  (testing "renamed recordings"
+    (is (= {:date "2024-03-05" :journal "2024_03_05.md" :time "1230" :words "singing in the rain" :ext "mp3"}
+           (sorting/parse-name "2024-03-05_1230_Singing-in-the-rain.mp3")))
+    (is (= "hello world" (:words (sorting/parse-name "2024-03-05_1230_01_hello-world.m4a")))))
+  (testing "names that weren't renamed"
+    (is (nil? (sorting/parse-name "240305_1230.mp3")))
+    (is (nil? (sorting/parse-name "2024-03-05_1230_notes.txt")))))
+
+(defn- match [config file-name transcript]
+  (:name (sorting/match-rule (sorting/compile-rules config) (sorting/parse-name file-name) transcript)))
+
+(deftest compile-rules-test
+  (let [config {:logseq {:enable true}
+                :folders [[:songs {:keywords ["Singing"] :dir "/songs"}]
+                          [:meetings {:regexes ["\\bmeeting\\b"] :from "2024-01-01" :to "2024-06-30" :dir "/meetings"}]]
+                :tags [[:health {:keywords ["health"] :tag-str "health"}]]}]
+    (testing "keywords match the start of the words, case insensitive"
+      (is (= :songs (match config "2024-03-05_1230_singing-in-the-rain.mp3" nil)))
+      (is (nil? (match config "2024-03-05_1230_me-singing.mp3" nil))))
+    (testing "regexes match the words or the transcript, within the date range"
+      (is (= :meetings (match config "2024-03-05_1230_weekly-sync.mp3" "Notes of the Meeting with the team")))
+      (is (nil? (match config "2024-07-05_1230_weekly-sync.mp3" "notes of the meeting")))
+      (is (nil? (match config "2024-03-05_1230_weekly-sync.mp3" "meetings"))))
+    (testing "folder rules come before tags"
+      (is (= :health (match config "2024-03-05_1230_health-check.mp3" nil)))
+      (is (= :songs (match (update config :tags conj [:singing {:keywords ["singing"]}])
+                           "2024-03-05_1230_singing.mp3" nil))))
+    (testing "disabled rules"
+      (is (nil? (match (assoc-in config [:logseq :enable] false) "2024-03-05_1230_health-check.mp3" nil)))
+      (is (nil? (match (assoc config :sorting {:enable false}) "2024-03-05_1230_singing.mp3" nil))))))
+
+(deftest claim-name-test
+  (let [dir (fs/create-temp-dir)]
+    (try
+      (spit (str (fs/path dir "a.mp3")) "")
+      (let [destinations (atom {})]
+        (is (= "a_1.mp3" (sorting/claim-name! destinations dir "a.mp3")))
+        (is (= "a_2.mp3" (sorting/claim-name! destinations dir "a.mp3")) "claimed names are taken without listing dir again")
+        (is (= "b.mp3" (sorting/claim-name! destinations dir "b.mp3"))))
+      (finally (fs/delete-tree dir)))))
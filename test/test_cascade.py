@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "scripts"))
+
+import alchemize
+
+
+def segment(start, end, text, words=None):
+    seg = {"start": start, "end": end, "text": text}
+    if words is not None:
+        seg["words"] = [{"start": s, "end": e, "word": w} for s, e, w in words]
+    return seg
+
+
+def test_weak_spans_are_padded_and_merged():
+    weak = [segment(1.0, 2.0, ""), segment(2.5, 3.0, ""), segment(8.0, 9.8, "")]
+    spans = alchemize.weak_spans(weak, 10.0, pad=0.5)
+
+    # the first two overlap once padded, the last one is clipped to the audio
+    assert spans == [[0.5, 3.5, 1.0, 3.0], [7.5, 10.0, 8.0, 9.8]]
+
+
+def test_splice_segments_replaces_the_centered_segments():
+    segments = [segment(0.0, 2.0, " keep"), segment(2.0, 4.0, " weak"), segment(4.0, 6.0, " keep too")]
+    replacement = [segment(1.5, 2.1, " padding"), segment(2.1, 3.9, " fixed"), segment(3.9, 4.5, " padding")]
+    spliced = alchemize.splice_segments(segments, replacement, 2.0, 4.0)
+
+    assert [seg["text"] for seg in sorted(spliced, key=lambda seg: seg["start"])] == [" keep", " fixed", " keep too"]
+
+
+def test_splice_segments_drops_the_padded_words_of_a_single_segment():
+    segments = [segment(0.0, 2.0, " one two"), segment(2.0, 4.0, " tree for"), segment(4.0, 6.0, " five six")]
+    replacement = [segment(1.5, 4.5, " two three four five",
+                           [(1.5, 1.9, " two"), (2.1, 2.9, " three"), (3.0, 3.8, " four"), (4.0, 4.5, " five")])]
+    spliced = alchemize.splice_segments(segments, replacement, 2.0, 4.0)
+
+    fixed = [seg for seg in spliced if seg["text"] == " three four"]
+    assert len(spliced) == 3 and len(fixed) == 1
+    assert (fixed[0]["start"], fixed[0]["end"]) == (2.1, 3.8)
+    assert "words" not in fixed[0]
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "scripts"))
+
+import alchemize
+
+SR = alchemize.SAMPLE_RATE
+
+
+def noise(seconds, amplitude=0.3):
+    return (amplitude * np.random.default_rng(0).standard_normal(int(seconds * SR))).astype(np.float32)
+
+
+def test_short_audio_is_a_single_chunk():
+    audio = noise(5)
+    assert alchemize.chunk_bounds(audio, 10, 1) == [(0, len(audio), 0, len(audio))]
+
+
+def test_chunks_are_cut_at_the_quietest_frame_and_cover_the_audio():
+    audio = noise(25)
+    # a quiet spot in the last quarter of the first chunk
+    audio[int(8.5 * SR):int(8.7 * SR)] = 0
+    bounds = alchemize.chunk_bounds(audio, 10, 1)
+
+    cut = bounds[0][3]
+    assert 8.5 * SR <= cut <= 8.7 * SR
+    # the owned parts follow each other without gaps
+    assert bounds[0][2] == 0 and bounds[-1][3] == len(audio)
+    for (_, _, _, own_end), (_, _, own_start, _) in zip(bounds, bounds[1:]):
+        assert own_end == own_start
+    # every chunk is at most chunk_seconds plus the overlap on both sides
+    for start, end, own_start, own_end in bounds:
+        assert own_end - own_start <= 10 * SR
+        assert start == max(0, own_start - SR) and end == min(len(audio), own_end + SR)
+
+
+def test_stitch_chunks_keeps_each_segment_once():
+    bounds = [(0, 11 * SR, 0, 10 * SR), (9 * SR, 20 * SR, 10 * SR, 20 * SR)]
+    chunk_results = [
+        {"language": "en", "segments": [{"start": 0.0, "end": 5.0, "text": " one"},
+                                         {"start": 9.0, "end": 11.0, "text": " two"}]},
+        # the second chunk starts at 9s, its first segment is the one repeated in the overlap
+        {"language": "en", "segments": [{"start": 0.0, "end": 2.0, "text": " two"},
+                                         {"start": 2.0, "end": 6.0, "text": " three"}]},
+    ]
+    result = alchemize.stitch_chunks(chunk_results, bounds)
+
+    assert result["text"] == " one two three"
+    assert [(seg["start"], seg["end"]) for seg in result["segments"]] == [(0.0, 5.0), (9.0, 11.0), (11.0, 15.0)]
+    assert [seg["id"] for seg in result["segments"]] == [0, 1, 2]
@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "scripts"))
+
+import alchemize
+
+VALUE = {"text": "x" * 90}
+
+
+def filled_cache(tmp_path, results):
+    cache = alchemize.ResultCache(str(tmp_path))
+    keys = [cache.key(str(n), "transcription", "base", "en", {}) for n in range(results)]
+    for n, key in enumerate(keys):
+        cache.put(key, VALUE)
+        os.utime(cache.path(key), (n, n))
+    return cache, keys
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache, keys = filled_cache(tmp_path, 3)
+    # reading the first result makes the second the least recently used
+    assert cache.get(keys[0]) == VALUE
+
+    # a result being written by another process isn't counted or removed
+    tmp_file = os.path.join(os.path.dirname(cache.path(keys[0])), "other.tmp")
+    with open(tmp_file, "w") as other:
+        other.write("x" * 1000)
+    cache.max_bytes = 2 * os.path.getsize(cache.path(keys[0]))
+    cache.evict()
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == VALUE and cache.get(keys[2]) == VALUE
+    assert os.path.exists(tmp_file)
+    assert cache.total_bytes == cache.max_bytes
+
+
+def test_overwriting_a_result_keeps_the_total_size(tmp_path):
+    cache, keys = filled_cache(tmp_path, 2)
+    total_bytes = cache.total_bytes
+
+    cache.put(keys[0], VALUE)
+
+    assert total_bytes == cache.total_bytes == 2 * os.path.getsize(cache.path(keys[0]))
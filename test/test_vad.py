@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "scripts"))
+
+import alchemize
+
+SR = alchemize.SAMPLE_RATE
+
+
+def tone(seconds, amplitude=0.5):
+    t = np.arange(int(seconds * SR)) / SR
+    return (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * SR), dtype=np.float32)
+
+
+def test_speech_regions_are_padded_and_split_at_long_silences():
+    audio = np.concatenate([silence(1), tone(1), silence(2), tone(1), silence(1)])
+    regions = alchemize.speech_regions(audio, min_silence=1.0, pad=0.3)
+
+    assert len(regions) == 2
+    (start_1, end_1), (start_2, end_2) = regions
+    assert abs(start_1 / SR - 0.7) < 0.05 and abs(end_1 / SR - 2.3) < 0.05
+    assert abs(start_2 / SR - 3.7) < 0.05 and abs(end_2 / SR - 5.3) < 0.05
+
+
+def test_speech_regions_bridge_short_silences():
+    audio = np.concatenate([silence(1), tone(1), silence(0.5), tone(1), silence(1)])
+    regions = alchemize.speech_regions(audio, min_silence=1.0, pad=0.3)
+
+    assert len(regions) == 1
+
+
+def test_speech_regions_of_silence():
+    assert alchemize.speech_regions(silence(3)) == []
+
+
+def test_remap_timestamps_maps_back_to_the_original_audio():
+    # speech at 1-2s and 4-5s, concatenated into 0-1s and 1-2s
+    regions = [(1 * SR, 2 * SR), (4 * SR, 5 * SR)]
+    result = {"segments": [
+        {"start": 0.5, "end": 1.0, "words": [{"start": 0.5, "end": 1.0}]},
+        {"start": 1.0, "end": 1.5},
+    ]}
+    alchemize.remap_timestamps(result, regions)
+
+    first, second = result["segments"]
+    # an end on a region boundary stays in the region before it, a start goes to the region after it
+    assert (first["start"], first["end"]) == (1.5, 2.0)
+    assert (first["words"][0]["start"], first["words"][0]["end"]) == (1.5, 2.0)
+    assert (second["start"], second["end"]) == (4.0, 4.5)